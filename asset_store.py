@@ -0,0 +1,79 @@
+# asset_store.py: ダウンロードした画像やスタイルシートと、処理したページ（JSON）を置いておく場所。
+# 中身はメモリに持たず、sha256をファイル名にしてディスクに書き出す（同じ中身のものは一度だけ書かれる）。
+# スクレイパーやEpubMakerは軽いAssetHandleだけを持ち、中身はepubに書き込むときに読む。
+import os
+import shutil
+import hashlib
+import tempfile
+
+class AssetHandle:
+
+    def __init__(self, path, digest, size):
+        self.path = path
+        self.digest = digest
+        self.size = size
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+    # 先頭のn bytesだけを読む（MIMEの判定などに使う）
+    def head(self, n=65536):
+        with self.open() as f:
+            return f.read(n)
+
+class AssetStore:
+
+    # pathがNoneなら一時ディレクトリを作り、cleanup()で消す
+    def __init__(self, path=None):
+        if path == None:
+            self.path = tempfile.mkdtemp(prefix="wiki2epub-assets-")
+            self.temporary = True
+        else:
+            self.path = path
+            self.temporary = False
+            os.makedirs(path, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    # chunksから読みながら書き出してAssetHandleを返す
+    def put_stream(self, chunks):
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+            path = self.blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return AssetHandle(path, digest, size)
+
+    def put(self, data):
+        return self.put_stream([data])
+
+    # 既に書き出してあるものを中身のsha256から取り出す。無ければNone。
+    def get(self, digest):
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            return None
+        return AssetHandle(path, digest, os.path.getsize(path))
+
+    def cleanup(self):
+        if self.temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
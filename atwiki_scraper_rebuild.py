@@ -1,9 +1,9 @@
 # atwiki.jp scraper
 
 import sys
-from webutil import *
 from atwiki_scraper import AtwikiScraper
 
 if __name__ == '__main__':
-    scraper = AtwikiScraper(int(sys.argv[1]), sys.argv[2])
-    scraper.make(sys.argv[3], sys.argv[4], record_mode="none")
\ No newline at end of file
+    args = [arg for arg in sys.argv[1:] if arg != "--resume"]
+    scraper = AtwikiScraper(int(args[0]), args[1])
+    scraper.make(args[2], args[3], record_mode="none", incremental=True, resume="--resume" in sys.argv)
\ No newline at end of file
@@ -0,0 +1,125 @@
+# batch.py: たくさんのwikiをひとつのプロセスでまとめてepubにする。
+#
+# python batch.py <マニフェスト> [サマリの出力先]
+#
+# マニフェストはJSONで、ビルドのリストか、設定とビルドのリストを持つオブジェクト。
+# {
+#     "concurrency": 4,       同時に進めるビルドの数
+#     "workers": 16,          全てのビルドで共有するダウンロード用のスレッドの数
+#     "asset_dir": null,      全てのビルドで共有するファイルの置き場所（nullならビルドごとに<epub>.crawl/assets）
+#     "builds": [
+#         {"type": "wikiwiki", "wiki_id": "sample", "epub": "out/sample.epub", "cache": "cache/sample"},
+#         {"type": "atwiki", "server_id": 1, "wiki_id": "sample", "epub": "out/sample_at.epub", "cache": "cache/sample_at",
+#          "record_mode": "none", "incremental": true}
+#     ]
+# }
+# ビルドには他にdelta, resume, page_only, parser, book_id, image_profile, log_format, metrics_fileを指定できる。
+#
+# 接続プールとレート制限（webutil）、ダウンロード用のスレッド、コンパイル済みのテンプレート（maker.templates）は全てのビルドで共有する。
+# ダウンロードしたファイルの置き場所は、asset_dirを指定したときだけ共有する。途中経過（resume）はそこにあるファイルを指すので、
+# 一時ディレクトリを共有にはしない（バッチが終わったら消えて、再開できなくなる）。
+# vcrのカセットを使うビルドは、カセットが全てのリクエストを横取りしてしまうので、他のビルドが終わってから一つずつ行う。
+# サマリ（デフォルトは<マニフェスト>.summary.json）には、ビルドごとの結果、かかった時間、ページとファイルの数、エラー、計測結果（metrics.Metrics.snapshot）を書き出す。
+import os
+import sys
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from wikiwiki_scraper import WikiwikiScraper
+from atwiki_scraper import AtwikiScraper
+
+MAKE_OPTIONS = ("record_mode", "incremental", "delta", "resume")
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {"builds": manifest}
+    return manifest
+
+def create_scraper(build):
+    if build.get("type", "wikiwiki") == "atwiki":
+        scraper = AtwikiScraper(int(build["server_id"]), build["wiki_id"], build.get("book_id"))
+    elif build.get("type", "wikiwiki") == "wikiwiki":
+        scraper = WikiwikiScraper(build["wiki_id"], build.get("book_id"))
+    else:
+        raise(Exception("Unknown scraper type: " + str(build.get("type"))))
+    scraper.page_only = build.get("page_only", False)
+    scraper.parser = build.get("parser", scraper.parser)
+    scraper.image_profile = build.get("image_profile")
+    scraper.log_format = build.get("log_format", scraper.log_format)
+    scraper.metrics_path = build.get("metrics_file")
+    return scraper
+
+# ビルドをひとつ行い、サマリの項目を返す
+def run_build(build, executor, asset_dir):
+    result = {"type": build.get("type", "wikiwiki"), "wiki_id": build.get("wiki_id"), "epub": build.get("epub"), "status": "ok"}
+    start = time.perf_counter()
+    scraper = None
+    try:
+        scraper = create_scraper(build)
+        scraper.shared_executor = executor
+        scraper.asset_dir = asset_dir
+        options = dict((k, build[k]) for k in MAKE_OPTIONS if k in build)
+        scraper.make(build["epub"], build["cache"], **options)
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+        result["traceback"] = traceback.format_exc()
+        print("build failed: " + str(build.get("wiki_id")) + ": " + str(e))
+    result["seconds"] = time.perf_counter() - start
+    if scraper != None:
+        result["pages"] = len(scraper.pages)
+        result["files"] = len(scraper.files)
+        result["metrics"] = scraper.metrics.snapshot()
+    return result
+
+def run_batch(manifest):
+    builds = manifest["builds"]
+    concurrency = manifest.get("concurrency", 4)
+    workers = manifest.get("workers", 16)
+
+    asset_dir = manifest.get("asset_dir")
+
+    results = [None] * len(builds)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # vcrのカセットを使うビルドは最後に一つずつ行う
+        cassette = [i for i, build in enumerate(builds) if os.path.isfile(build["cache"])]
+        concurrent = [i for i in range(len(builds)) if not i in cassette]
+
+        with ThreadPoolExecutor(max_workers=concurrency) as runner:
+            futures = [(i, runner.submit(run_build, builds[i], executor, asset_dir)) for i in concurrent]
+            for i, future in futures:
+                results[i] = future.result()
+
+        for i in cassette:
+            results[i] = run_build(builds[i], executor, asset_dir)
+
+    return {
+        "seconds": time.perf_counter() - start,
+        "succeeded": sum(1 for result in results if result["status"] == "ok"),
+        "failed": sum(1 for result in results if result["status"] != "ok"),
+        "builds": results,
+    }
+
+# マニフェストのビルドを全て行い、サマリ（summary_pathがNoneなら<マニフェスト>.summary.json）を書き出して結果を表示する。
+# 終了コード（失敗したビルドがあれば1）を返す。
+def run_manifest(manifest_path, summary_path=None):
+    summary = run_batch(load_manifest(manifest_path))
+
+    if summary_path == None:
+        summary_path = manifest_path + ".summary.json"
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    print("%d succeeded, %d failed in %.1f s (summary: %s)" % (summary["succeeded"], summary["failed"], summary["seconds"], summary_path))
+    return 1 if summary["failed"] else 0
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python batch.py <manifest> [summary]")
+        sys.exit(1)
+
+    sys.exit(run_manifest(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
@@ -0,0 +1,160 @@
+# bench_site.py: ベンチマーク用の、wikiwikiやatwikiのふりをするローカルのHTTPサーバ。
+#
+# python bench_site.py wikiwiki|atwiki [ページ数] [ポート]
+#
+# ページ、画像、CSS、サイトマップ（atwikiはページ分け）を設定された数だけ、決まった中身で作って返す。
+# 中身はリクエストされたときに作るので、大きなサイトでもメモリはあまり使わない。
+# /_statsでリクエストの数と返したバイト数をJSONで返す（/_stats?resetで0に戻す）。
+import sys
+import json
+import zlib
+import struct
+import threading
+import http.server
+
+WIKI_ID = "bench"
+
+class SyntheticWiki:
+
+    # kind: "wikiwiki"か"atwiki"
+    # images: サイト全体の画像の種類の数（ページ間で使い回すので、同じ画像を参照するページがある）
+    def __init__(self, kind="wikiwiki", pages=200, images_per_page=4, images=None, image_size=64, css_files=2, paragraphs=30, sitemap_page_size=100):
+        self.kind = kind
+        self.pages = pages
+        self.images_per_page = images_per_page
+        self.images = images if images != None else max(1, pages * images_per_page // 2)
+        self.image_size = image_size
+        self.css_files = css_files
+        self.paragraphs = paragraphs
+        self.sitemap_page_size = sitemap_page_size
+        self.root = None # "http://127.0.0.1:<port>/"（serveで決まる）
+
+    def base_url(self):
+        return self.root + WIKI_ID + "/"
+
+    def page_url(self, i):
+        if self.kind == "atwiki":
+            return self.base_url() + "pages/%d.html" % i
+        return self.base_url() + "?Page%d" % i
+
+    def head(self, title):
+        links = "".join('<link rel="stylesheet" href="/css/%d.css?v=1">' % k for k in range(self.css_files))
+        meta = '<meta property="og:site_name" content="Bench Wiki">' if self.kind == "atwiki" else ""
+        return '<head><meta charset="utf-8"><title>%s</title>%s%s<script>track()</script></head>' % (title, meta, links)
+
+    def page(self, i):
+        images = "".join('<img src="/img/%d.png" alt="figure">' % ((i * self.images_per_page + j) % self.images) for j in range(self.images_per_page))
+        paragraphs = "".join(
+            '<p onclick="x()">段落 %d / ページ %d。<a href="%s">次のページ</a>、<a href="#h%d">見出し</a>、<a href="http://example.com/%d">外部</a>。'
+            '<span style="display:none">hidden</span><strong>強調</strong>とテキストの繰り返し。%s</p>'
+            % (j, i, self.page_url((i + j + 1) % self.pages), j, j, "あいうえお" * 8) for j in range(self.paragraphs))
+        table = "<table><tr><th>a</th><th>b</th></tr>%s</table>" % "".join("<tr><td>%d</td><td>%d</td></tr>" % (k, k * i) for k in range(10))
+        body = '<body><div id="body"><h2 id="h0">Page %d</h2>%s%s%s</div><script>z()</script></body>' % (i, images, paragraphs, table)
+        return "<html>%s%s</html>" % (self.head("Page %d" % i), body)
+
+    def top(self):
+        return "<html>%s<body><div id=\"body\">top</div></body></html>" % self.head("Bench Wiki")
+
+    # wikiwikiのページ一覧
+    def wikiwiki_list(self):
+        items = "".join('<li><a href="%s">Page%d</a></li>' % (self.page_url(i), i) for i in range(self.pages))
+        return '<html>%s<body><div id="body"><ul><li>P<ul>%s</ul></li></ul></div></body></html>' % (self.head("list"), items)
+
+    # atwikiのページ一覧。pp番目のページ（Noneなら最初のページ）
+    def atwiki_list(self, pp=None):
+        number = max(1, (self.pages + self.sitemap_page_size - 1) // self.sitemap_page_size)
+        current = pp if pp != None else 0
+        pager = "".join(("<span>%d</span>" % (k + 1)) if k == current else ('<a href="?pp=%d">%d</a>' % (k, k + 1)) for k in range(number))
+        rows = "".join('<tr><td><a href="%s">Page%d</a></td><td>2026-01-01 00:00:00</td></tr>' % (self.page_url(i), i)
+                       for i in range(current * self.sitemap_page_size, min(self.pages, (current + 1) * self.sitemap_page_size)))
+        return '<html>%s<body><div class="pagelist"><p>list</p><p>sort</p><p>%s</p></div><table class="pagelist">%s</table></body></html>' % (self.head("list"), pager, rows)
+
+    def image(self, k):
+        size = self.image_size
+        raw = b"".join(b"\x00" + bytes(((k * 31 + x * 7 + y * 13) % 256) for x in range(size * 3)) for y in range(size))
+        def chunk(kind, data):
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+        return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+    def css(self, k):
+        return "".join(".c%d-%d { color: #%06x; margin: %dpx; }\n" % (k, n, n * 997 % 0xffffff, n % 20) for n in range(200))
+
+    # パス（クエリを含む）から(ステータス, Content-Type, 中身)を返す
+    def respond(self, path):
+        base = "/" + WIKI_ID + "/"
+        if path.startswith("/img/"):
+            return (200, "image/png", self.image(int(path[5:].split(".")[0])))
+        if path.startswith("/css/"):
+            return (200, "text/css", self.css(int(path[5:].split(".")[0])))
+        if path == base:
+            return (200, "text/html", self.top())
+        if self.kind == "wikiwiki":
+            if path == base + "?cmd=list":
+                return (200, "text/html", self.wikiwiki_list())
+            if path.startswith(base + "?Page"):
+                i = int(path[len(base) + 5:])
+                if i < self.pages:
+                    return (200, "text/html", self.page(i))
+        else:
+            if path == base + "list":
+                return (200, "text/html", self.atwiki_list())
+            if path.startswith(base + "list?sort=create&pp="):
+                return (200, "text/html", self.atwiki_list(int(path.split("pp=")[1])))
+            if path.startswith(base + "pages/"):
+                i = int(path[len(base) + 6:].split(".")[0])
+                if i < self.pages:
+                    return (200, "text/html", self.page(i))
+        return (404, "text/plain", "not found")
+
+class SyntheticWikiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith("/_stats"):
+            with server.lock:
+                body = json.dumps(server.stats)
+                if self.path.endswith("?reset"):
+                    server.stats = {"requests": 0, "bytes": 0}
+            status, content_type, body = (200, "application/json", body.encode("utf-8"))
+        else:
+            status, content_type, body = server.site.respond(self.path)
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            with server.lock:
+                server.stats["requests"] += 1
+                server.stats["bytes"] += len(body)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# サイトをローカルのポートで返すサーバを作る（port=0なら空いているポート）。serve_forever()は呼び出す側で行う。
+def create_server(site, port=0):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), SyntheticWikiHandler)
+    server.daemon_threads = True
+    server.site = site
+    server.lock = threading.Lock()
+    server.stats = {"requests": 0, "bytes": 0}
+    site.root = "http://127.0.0.1:%d/" % server.server_address[1]
+    return server
+
+# 別のプロセスでサーバを動かすときの入口。決まったポートをqueueに入れる。
+def serve(options, queue=None):
+    server = create_server(SyntheticWiki(**options))
+    if queue != None:
+        queue.put(server.server_address[1])
+    server.serve_forever()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or not sys.argv[1] in ("wikiwiki", "atwiki"):
+        print("usage: python bench_site.py wikiwiki|atwiki [pages] [port]")
+        sys.exit(1)
+    site = SyntheticWiki(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+    server = create_server(site, int(sys.argv[3]) if len(sys.argv) > 3 else 8000)
+    print("serving %d %s pages at %s" % (site.pages, site.kind, site.base_url()))
+    server.serve_forever()
@@ -0,0 +1,320 @@
+# benchmark.py: 性能を測るためのスクリプト。
+#
+# python benchmark.py render [ページ数]
+#   genshiのテンプレートを通すページ(addPage)と、シリアライズ済みのページ(addXhtmlPage)で、
+#   EpubMaker.doMakeにかかる1ページあたりの時間を比べる。
+#
+# python benchmark.py parsers <レスポンスストア> [wikiwiki|atwiki]
+#   レスポンスストアに記録されたwikiのHTMLを、BeautifulSoupとlxmlのそれぞれでページとして処理し、かかる時間を比べる。
+#   ダウンロードはしない（page_only）。
+#
+# python benchmark.py compress [ページ数]
+#   無圧縮、その場で圧縮、スレッドで並列に圧縮のそれぞれで、epubを作る時間と大きさを比べる。
+#
+# python benchmark.py e2e [ページ数] [1ページあたりの画像の数] [JSONの出力先]
+#   bench_site.pyの偽のwikiwikiとatwikiを別のプロセスで立て、それぞれをクロール（new_episodes）してから、
+#   レスポンスストアだけから作り直す（none）。ビルドごとに、段階（サイトマップ、ページ、epubの生成）ごとの時間、
+#   1秒あたりのリクエスト数、最大のメモリ使用量（RSS）、epubの大きさを出す。最後にmicroも行う。
+#
+# python benchmark.py micro [ページ数]
+#   LinkRewriter.process_elementの1要素あたりの時間と、renderPageの1ページあたりの時間を測る。
+#
+# python benchmark.py startup [回数]
+#   wiki2epub.pyの起動（--help）と、スクレイパーのimportにかかる時間を測る。
+#   Python自体の起動時間を引いた値がSTARTUP_BUDGETを超えたら、終了コード1で終わる。
+import os
+import sys
+import time
+import tempfile
+import io
+import contextlib
+import subprocess
+from maker import EpubMaker
+
+# 起動にかかる時間の上限（秒）。Python自体の起動時間は含まない。
+STARTUP_BUDGET = {
+	"wiki2epub.py --help": 0.05,
+	"import wikiwiki_scraper": 0.4,
+}
+
+# それっぽいページの断片を作る
+def synthetic_page(i):
+	head = '<head><title>Page %d</title><link href="../files/style.css" rel="stylesheet" type="text/css"/></head>' % i
+	paragraphs = "".join('<p>Paragraph %d of page %d with <a href="%d.xhtml">a link</a> and <img src="../files/%d.png"/></p>' % (j, i, j, j) for j in range(50))
+	body = '<body><div id="body"><h1>Page %d</h1>%s</div></body>' % (i, paragraphs)
+	return head, body
+
+def bench_render(number_of_pages):
+	pages = [synthetic_page(i) for i in range(number_of_pages)]
+
+	for kind in ("template", "xhtml"):
+		maker = EpubMaker("ja-JP", "benchmark", "benchmark", "benchmark", "benchmark")
+		for i, (head, body) in enumerate(pages):
+			if kind == "template":
+				maker.addPage("p%d" % i, "Page %d" % i, {"head": head, "body": body})
+			else:
+				maker.addXhtmlPage("p%d" % i, "Page %d" % i, {"head": head, "body": body})
+
+		fd, path = tempfile.mkstemp(suffix=".epub")
+		os.close(fd)
+		try:
+			start = time.perf_counter()
+			maker.doMake(path)
+			elapsed = time.perf_counter() - start
+		finally:
+			os.remove(path)
+		print("%-8s %d pages: %.3f s (%.3f ms/page)" % (kind, number_of_pages, elapsed, elapsed * 1000 / number_of_pages))
+
+# 無圧縮、その場で圧縮、スレッドで並列に圧縮の、それぞれでepubを作る時間と大きさを比べる
+def bench_compress(number_of_pages):
+	pages = [synthetic_page(i) for i in range(number_of_pages)]
+
+	for name, level, threads in (("stored", None, 0), ("deflate", 6, 0), ("deflate x4", 6, 4)):
+		maker = EpubMaker("ja-JP", "benchmark", "benchmark", "benchmark", "benchmark")
+		maker.compress_level = level
+		maker.compress_threads = threads
+		for i, (head, body) in enumerate(pages):
+			maker.addXhtmlPage("p%d" % i, "Page %d" % i, {"head": head, "body": body})
+
+		fd, path = tempfile.mkstemp(suffix=".epub")
+		os.close(fd)
+		try:
+			start = time.perf_counter()
+			maker.doMake(path)
+			elapsed = time.perf_counter() - start
+			size = os.path.getsize(path)
+		finally:
+			os.remove(path)
+		print("%-10s %d pages: %.3f s, %d bytes" % (name, number_of_pages, elapsed, size))
+
+def bench_parsers(store_path, kind="wikiwiki"):
+	from response_store import ResponseStore
+
+	store = ResponseStore(store_path, "none")
+	bodies = [obj.content for obj in store.responses() if obj.status_code == 200 and obj.headers.get("Content-Type", "").startswith("text/html")]
+	store.close()
+
+	results = {}
+	for parser in ("bs4", "lxml"):
+		if kind == "atwiki":
+			from atwiki_scraper import AtwikiScraper
+			scraper = AtwikiScraper(1, "benchmark")
+		else:
+			from wikiwiki_scraper import WikiwikiScraper
+			scraper = WikiwikiScraper("benchmark")
+		scraper.page_only = True
+		scraper.parser = parser
+
+		size = 0
+		with contextlib.redirect_stdout(io.StringIO()): # dropped urlなどの出力は捨てる
+			start = time.perf_counter()
+			for body in bodies:
+				title, data = scraper.process_page(body)
+				size += len(data["head"]) + len(data["body"])
+			elapsed = time.perf_counter() - start
+		results[parser] = elapsed
+		print("%-5s %d pages: %.3f s (%.3f ms/page, %d chars of output)" % (parser, len(bodies), elapsed, elapsed * 1000 / max(1, len(bodies)), size))
+
+	if results["lxml"] > 0:
+		print("lxml is %.2fx as fast as bs4" % (results["bs4"] / results["lxml"]))
+
+# 呼ぶたびにかかった時間をphases[name]に足していく
+def timed(phases, name, fn):
+	def wrapper(*args, **kwargs):
+		start = time.perf_counter()
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			phases[name] = phases.get(name, 0) + time.perf_counter() - start
+	return wrapper
+
+# ジェネレータを最後まで回すのにかかった時間（受け取る側の時間も含む）をphases[name]に入れる
+def timed_generator(phases, name, fn):
+	def wrapper(*args, **kwargs):
+		start = time.perf_counter()
+		for item in fn(*args, **kwargs):
+			yield item
+		phases[name] = time.perf_counter() - start
+	return wrapper
+
+# ビルドをひとつ行う。ビルドごとのメモリ使用量を測るため、別のプロセスで呼ばれる。
+def run_e2e_build(kind, root, path, store, record_mode):
+	import resource
+	from bench_site import WIKI_ID
+
+	if kind == "atwiki":
+		from atwiki_scraper import AtwikiScraper
+		scraper = AtwikiScraper(0, WIKI_ID, "benchmark")
+	else:
+		from wikiwiki_scraper import WikiwikiScraper
+		scraper = WikiwikiScraper(WIKI_ID, "benchmark")
+	scraper.rooturl = root
+	scraper.base_url = root + WIKI_ID + "/"
+	scraper.request_rate = 1000000 # ローカルのサーバなのでレート制限はしない
+	scraper.request_burst = 1000000
+	scraper.checkpoint_interval = 0
+
+	phases = {}
+	scraper.get_all_urls = timed(phases, "sitemap", scraper.get_all_urls)
+	scraper.generate_pages = timed_generator(phases, "pages", scraper.generate_pages)
+	EpubMaker.doMake = timed(phases, "epub", EpubMaker.doMake)
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		start = time.perf_counter()
+		scraper.make(path, store, record_mode=record_mode)
+		total = time.perf_counter() - start
+	phases["other"] = total - sum(phases.values())
+
+	return {
+		"phases": phases,
+		"seconds": total,
+		"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		"size": os.path.getsize(path),
+		"pages": len(scraper.pages),
+		"files": len(scraper.files),
+	}
+
+# 偽のwikiのリクエスト数と返したバイト数
+def site_stats(root, reset=False):
+	import json
+	from urllib.request import urlopen
+	with urlopen(root + "_stats" + ("?reset" if reset else "")) as f:
+		return json.load(f)
+
+def bench_e2e(number_of_pages=200, images_per_page=4, json_path=None):
+	import json
+	import shutil
+	import multiprocessing
+	from concurrent.futures import ProcessPoolExecutor
+	import bench_site
+
+	context = multiprocessing.get_context("spawn")
+	workdir = tempfile.mkdtemp(prefix="wiki2epub-benchmark-")
+	results = []
+	try:
+		for kind in ("wikiwiki", "atwiki"):
+			queue = context.Queue()
+			server = context.Process(target=bench_site.serve, args=({"kind": kind, "pages": number_of_pages, "images_per_page": images_per_page}, queue), daemon=True)
+			server.start()
+			try:
+				root = "http://127.0.0.1:%d/" % queue.get(timeout=30)
+				store = os.path.join(workdir, kind + ".store")
+				for run, record_mode in (("crawl", "new_episodes"), ("rebuild", "none")):
+					site_stats(root, reset=True)
+					with ProcessPoolExecutor(1, mp_context=context) as executor:
+						result = executor.submit(run_e2e_build, kind, root, os.path.join(workdir, "%s_%s.epub" % (kind, run)), store, record_mode).result()
+					stats = site_stats(root)
+					network = result["phases"].get("sitemap", 0) + result["phases"].get("pages", 0)
+					result.update({"site": kind, "run": run, "requests": stats["requests"], "bytes": stats["bytes"]})
+					result["requests_per_second"] = stats["requests"] / network if network > 0 else 0
+					results.append(result)
+					print("%-8s %-7s %d pages, %d files: %.2f s (sitemap %.2f s, pages %.2f s, epub %.2f s, other %.2f s), %d requests (%.0f req/s), peak RSS %.1f MB, %d bytes" % (
+						kind, run, result["pages"], result["files"], result["seconds"],
+						result["phases"].get("sitemap", 0), result["phases"].get("pages", 0), result["phases"].get("epub", 0), result["phases"]["other"],
+						result["requests"], result["requests_per_second"], result["peak_rss_kb"] / 1024, result["size"]))
+			finally:
+				server.terminate()
+				server.join()
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	micro = bench_micro(number_of_pages)
+
+	if json_path != None:
+		with open(json_path, 'w') as f:
+			json.dump({"pages": number_of_pages, "images_per_page": images_per_page, "builds": results, "micro": micro}, f, indent=2)
+
+def bench_micro(number_of_pages=200):
+	from bs4 import BeautifulSoup
+	from genshi.template import Context
+	from maker import renderPage, templates
+	from wikiwiki_scraper import WikiwikiScraper
+	from bench_site import SyntheticWiki, WIKI_ID
+
+	results = {}
+
+	# process_element（ダウンロードはしない）
+	site = SyntheticWiki("wikiwiki", number_of_pages)
+	site.root = "http://127.0.0.1/"
+	scraper = WikiwikiScraper(WIKI_ID, "benchmark")
+	scraper.rooturl = site.root
+	scraper.base_url = site.base_url()
+	scraper.page_only = True
+	soups = [BeautifulSoup(site.page(i), "lxml") for i in range(number_of_pages)]
+	elements = [element for soup in soups for element in soup.find_all(scraper.rewriter.is_target)]
+	with contextlib.redirect_stdout(io.StringIO()): # dropped urlなどの出力は捨てる
+		start = time.perf_counter()
+		for element in elements:
+			scraper.process_element(element)
+		elapsed = time.perf_counter() - start
+	results["process_element_us"] = elapsed * 1000000 / max(1, len(elements))
+	print("process_element %d elements: %.3f s (%.2f us/element)" % (len(elements), elapsed, results["process_element_us"]))
+
+	# renderPage
+	maker = EpubMaker("ja-JP", "benchmark", "benchmark", "benchmark", "benchmark")
+	ctx = Context(**maker.__dict__)
+	pages = [synthetic_page(i) for i in range(number_of_pages)]
+	for kind in ("template", "xhtml"):
+		start = time.perf_counter()
+		for i, (head, body) in enumerate(pages):
+			page = {"title": "Page %d" % i, "data": {"head": head, "body": body}}
+			if kind == "template":
+				page["template"] = "page.xhtml"
+			else:
+				page["xhtml"] = True
+			renderPage(templates, ctx, "p%d" % i, page)
+		elapsed = time.perf_counter() - start
+		results["render_%s_ms" % kind] = elapsed * 1000 / number_of_pages
+		print("renderPage %-8s %d pages: %.3f s (%.3f ms/page)" % (kind, number_of_pages, elapsed, results["render_%s_ms" % kind]))
+
+	return results
+
+# コマンドをruns回実行して、一番速かったときの時間を返す
+def fastest_run(command, runs):
+	best = None
+	for i in range(runs):
+		start = time.perf_counter()
+		subprocess.run(command, cwd=os.path.dirname(os.path.realpath(__file__)), stdout=subprocess.DEVNULL, check=True)
+		elapsed = time.perf_counter() - start
+		if best == None or elapsed < best:
+			best = elapsed
+	return best
+
+def bench_startup(runs=10):
+	bare = fastest_run([sys.executable, "-c", "pass"], runs)
+	print("%-24s %.1f ms" % ("python (bare)", bare * 1000))
+
+	commands = {
+		"wiki2epub.py --help": [sys.executable, "wiki2epub.py", "--help"],
+		"import wikiwiki_scraper": [sys.executable, "-c", "import wikiwiki_scraper"],
+	}
+	ok = True
+	for name, command in commands.items():
+		elapsed = fastest_run(command, runs) - bare
+		within = elapsed <= STARTUP_BUDGET[name]
+		ok = ok and within
+		print("%-24s +%.1f ms (budget %.1f ms) %s" % (name, elapsed * 1000, STARTUP_BUDGET[name] * 1000, "ok" if within else "OVER BUDGET"))
+	return ok
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] == "render":
+		bench_render(int(sys.argv[2]) if len(sys.argv) > 2 else 500)
+	elif sys.argv[1] == "parsers" and len(sys.argv) > 2:
+		bench_parsers(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "wikiwiki")
+	elif sys.argv[1] == "compress":
+		bench_compress(int(sys.argv[2]) if len(sys.argv) > 2 else 500)
+	elif sys.argv[1] == "e2e":
+		bench_e2e(int(sys.argv[2]) if len(sys.argv) > 2 else 200, int(sys.argv[3]) if len(sys.argv) > 3 else 4, sys.argv[4] if len(sys.argv) > 4 else None)
+	elif sys.argv[1] == "micro":
+		bench_micro(int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+	elif sys.argv[1] == "startup":
+		if not bench_startup(int(sys.argv[2]) if len(sys.argv) > 2 else 10):
+			sys.exit(1)
+	else:
+		print("usage: python benchmark.py render [pages]")
+		print("       python benchmark.py parsers <response store> [wikiwiki|atwiki]")
+		print("       python benchmark.py compress [pages]")
+		print("       python benchmark.py e2e [pages] [images per page] [json]")
+		print("       python benchmark.py micro [pages]")
+		print("       python benchmark.py startup [runs]")
+		sys.exit(1)
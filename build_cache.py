@@ -0,0 +1,69 @@
+# build_cache.py: 差分ビルドのためのキャッシュ。
+# epubの隣に<epub>.cache/を作り、ページのURLごとの情報を置いておく。
+# 変わっていないページとファイルは、出力先にある前回のepubからそのままコピーする。
+# 前回のepubは動かさない（新しいepubは一時ファイルに書いてから置き換えるので、ビルドに失敗しても残る。EpubMaker.doMakeを参照）。
+#
+# <epub>.cache
+# ├── index.json     URL → 本体のsha256, ページ名, タイトル, 使っているファイルとそのMIME, 中身が同じでまとめたファイル名（ページの順番通り）
+#                    と、最近の更新の一覧で前回見た最新の更新日時
+# └── images/        小さくした画像（image_optimizer.pyを参照。image_profileを指定したときだけ）
+import os
+import json
+import zipfile
+
+class BuildCache:
+
+    # options: ビルドの設定。前回と違っていたら前回のビルドは使わない
+    def __init__(self, path_to_epub, options={}):
+        self.path = path_to_epub + ".cache"
+        self.index_path = os.path.join(self.path, "index.json")
+        self.previous_epub = path_to_epub
+        os.makedirs(self.path, exist_ok=True)
+
+        # 以前は前回のepubをここに退避していた。出力先が無ければ（退避した後に失敗していたら）戻しておく
+        legacy_epub = os.path.join(self.path, "previous.epub")
+        if os.path.exists(legacy_epub):
+            if os.path.exists(path_to_epub):
+                os.remove(legacy_epub)
+            else:
+                os.replace(legacy_epub, path_to_epub)
+
+        self.options = options
+        self.previous = {}
+        self.entries = set()
+        self.last_changed = None # 最近の更新の一覧で見た最新の更新日時（"YYYY-MM-DD HH:MM:SS"）
+        if os.path.exists(self.index_path) and os.path.exists(self.previous_epub):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            if index.get("options") == options:
+                self.previous = index["pages"]
+                self.last_changed = index.get("last_changed")
+                with zipfile.ZipFile(self.previous_epub) as zipf:
+                    self.entries = set(zipf.namelist())
+
+        self.current = {}
+
+    # 本体が前回と同じで、前回のepubにページと使っているファイルが全て入っていれば、前回の情報を返す。
+    # fingerprintがNoneなら本体は比べない（更新されていないことが別の方法でわかっているとき）。
+    def lookup(self, url, fingerprint=None):
+        entry = self.previous.get(url)
+        if entry == None or (fingerprint != None and entry["fingerprint"] != fingerprint):
+            return None
+        if not "EPUB/pages/%s.xhtml" % entry["name"] in self.entries:
+            return None
+        for filename in entry["assets"]:
+            if not "EPUB/files/" + filename in self.entries:
+                return None
+        return entry
+
+    # 今回のビルドでのページの情報を記録する
+    # aliases: ページが参照しているファイル名のうち、中身が同じで他のファイル（assetsに入っている）にまとめたもの
+    def record(self, url, fingerprint, name, title, assets, aliases={}):
+        self.current[url] = {"fingerprint": fingerprint, "name": name, "title": title, "assets": assets, "aliases": aliases}
+
+    # epubができあがったら呼ぶ
+    def save(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"options": self.options, "pages": self.current, "last_changed": self.last_changed}, f)
+        os.replace(tmp, self.index_path)
@@ -0,0 +1,41 @@
+# crawl_state.py: 途中で止まったクロールを続きから再開するための状態。
+# epubの隣に<epub>.crawl/を作り、クロールの途中経過を定期的に書き出しておく。ビルドが終わったら消す。
+#
+# <epub>.crawl
+# ├── state.json  ページのURLの一覧、処理の終わったページ（ページ名, タイトル, 中身のsha256）、ダウンロードしたファイルなど
+# └── assets      ダウンロードしたファイルと処理したページ（asset_store.AssetStore）
+import os
+import json
+import shutil
+from asset_store import AssetStore
+
+class CrawlState:
+
+    # resume=Falseなら前回の状態は消して新しく始める
+    def __init__(self, path_to_epub, resume=False):
+        self.path = path_to_epub + ".crawl"
+        self.state_path = os.path.join(self.path, "state.json")
+
+        if not resume and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.state = None
+        if resume and os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+
+    # ダウンロードしたファイルと処理したページを置く場所
+    def asset_store(self):
+        return AssetStore(os.path.join(self.path, "assets"))
+
+    def save(self, state):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+        self.state = state
+
+    # ビルドが終わったら呼ぶ
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,176 @@
+# image_optimizer.py: ダウンロードした画像を電子書籍リーダー向けに小さくする。Pillowが必要（無ければ何もしない）。
+#
+# 大きすぎる画像は縮小し、E Ink向けのプロファイルではグレースケールにする。写真のようなPNGはJPEGにする。
+# JPEGにした画像は、epubに入れるときにWikiwikiScraper.dedupが拡張子を変えた名前にする（ページからの参照も向け直す）。
+# 変換はプロセスプールで行い、結果は元の画像のsha256と設定をキーにしてcache_dirに置いておくので、作り直すときは変換しない。
+#
+# <cache_dir>
+# ├── ab/abcd...       変換した画像（asset_store.AssetStore）
+# └── ab/abcd....json  元の画像のsha256と設定 → 変換した画像のsha256とメディアタイプ（nullなら元の画像のまま）
+import os
+import io
+import json
+import hashlib
+import threading
+from asset_store import AssetStore
+
+# max_size: 幅と高さの上限, grayscale: グレースケールにするか, jpeg_quality: JPEGの品質, png_to_jpeg: 写真のようなPNGをJPEGにするか
+PROFILES = {
+    "eink": {"max_size": [1072, 1448], "grayscale": True, "jpeg_quality": 75, "png_to_jpeg": True},
+    "tablet": {"max_size": [1600, 2560], "grayscale": False, "jpeg_quality": 85, "png_to_jpeg": True},
+}
+
+# 変換するメディアタイプ
+IMAGE_TYPES = ("image/jpeg", "image/png", "image/gif")
+
+# 色の数がこれより多いPNGは写真とみなす
+PHOTO_COLORS = 256
+
+# 画像をメディアタイプに合わせて書き出す
+def encode(image, mime, options):
+    buffer = io.BytesIO()
+    if mime == "image/jpeg":
+        if not image.mode in ("L", "RGB"):
+            image = image.convert("RGB")
+        image.save(buffer, "JPEG", quality=options["jpeg_quality"], optimize=True)
+    elif mime == "image/png":
+        image.save(buffer, "PNG", optimize=True)
+    else:
+        image.save(buffer, "GIF")
+    return buffer.getvalue()
+
+# 画像を変換して(中身, メディアタイプ)を返す。元の画像のままでよければNone。プロセスプールで呼ばれる。
+# 縮小やグレースケールにしても、元の画像より大きくなったものは使わない（色の少ない画像を縮小すると、中間の色が増えてPNGが大きくなる）。
+def transform(path, mime, options):
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as image:
+        if getattr(image, "is_animated", False):
+            return None
+        image.load()
+    changed = False
+
+    if mime == "image/jpeg" and image.getexif().get(0x0112, 1) != 1: # 回転が指定されていたら回しておく
+        image = ImageOps.exif_transpose(image)
+        changed = True
+    if image.mode == "P":
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    # 写真かどうかは色を減らす前に決める
+    out_mime = mime
+    if mime == "image/png" and options["png_to_jpeg"] and not "A" in image.getbands():
+        if image.getcolors(PHOTO_COLORS) == None:
+            out_mime = "image/jpeg"
+
+    max_size = tuple(options["max_size"])
+    if image.width > max_size[0] or image.height > max_size[1]:
+        image.thumbnail(max_size, Image.LANCZOS)
+        changed = True
+
+    if options["grayscale"] and not image.mode in ("L", "LA", "1"):
+        image = image.convert("LA" if "A" in image.getbands() else "L")
+        changed = True
+
+    if mime == "image/gif" and not changed:
+        return None # GIFは縮小したときだけ作り直す
+
+    size = os.path.getsize(path)
+    data = encode(image, out_mime, options)
+
+    # 大きくなったPNGは、色を減らしてもう一度試す
+    if out_mime == "image/png" and len(data) >= size and image.mode in ("L", "RGB"):
+        data = encode(image.quantize(PHOTO_COLORS), out_mime, options)
+
+    # 小さくならなかったら元の画像を使う
+    if len(data) >= size:
+        return None
+    return (data, out_mime)
+
+class ImageOptimizer:
+
+    # profile: PROFILESのキーか、同じ形の辞書
+    # processes: 変換に使うプロセスの数（Noneならos.cpu_count()）
+    # metrics: 変換した数などを記録して、進み具合を出力するmetrics.Metrics（Noneならprintする）
+    def __init__(self, profile, cache_dir, processes=None, metrics=None):
+        self.options = PROFILES[profile] if isinstance(profile, str) else profile
+        self.key = json.dumps(self.options, sort_keys=True)
+        self.cache = AssetStore(cache_dir)
+        self.processes = processes
+        self.executor = None
+        self.lock = threading.Lock()
+        self.enabled = True
+        self.converted = 0 # 変換した画像の数
+        self.cached = 0 # 前回の結果を使った画像の数
+        self.saved_bytes = 0 # 小さくなったバイト数
+        self.metrics = metrics
+        try:
+            import PIL
+        except ImportError:
+            self.report("image_optimizer_disabled", "Pillow is not installed. images are not optimized")
+            self.enabled = False
+
+    def report(self, event, message, **fields):
+        if self.metrics != None:
+            self.metrics.event(event, message, **fields)
+        else:
+            print(message)
+
+    def index_path(self, key):
+        return os.path.join(self.cache.path, key[:2], key + ".json")
+
+    # ダウンロードした画像（asset_store.AssetHandle）を変換して、storeに書き出した(AssetHandle, メディアタイプ)を返す。
+    # 変換しなかったら渡したものをそのまま返す。ダウンロード用のスレッドから呼ばれる。
+    def optimize(self, handle, mime, store):
+        if not self.enabled or not mime in IMAGE_TYPES:
+            return (handle, mime)
+
+        key = hashlib.sha256((handle.digest + self.key).encode("utf-8")).hexdigest()
+        index_path = self.index_path(key)
+        result = None
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                result = json.load(f)
+            optimized = self.cache.get(result["digest"]) if result["digest"] != None else None
+            if result["digest"] != None and (optimized == None or optimized.size >= handle.size):
+                result = None # 変換した画像が消えているか、元の画像より大きくなった以前の結果なら、変換し直す
+            else:
+                with self.lock:
+                    self.cached += 1
+
+        if result == None:
+            try:
+                transformed = self.submit(transform, handle.path, mime, self.options).result()
+            except Exception as e:
+                self.report("image_optimization_failed", "image optimization failed: " + str(e), error=str(e))
+                return (handle, mime)
+            result = {"digest": None, "mime": mime}
+            if transformed != None:
+                result = {"digest": self.cache.put(transformed[0]).digest, "mime": transformed[1]}
+            tmp = index_path + ".%d.tmp" % threading.get_ident()
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(result, f)
+            os.replace(tmp, index_path)
+            with self.lock:
+                self.converted += 1
+
+        if result["digest"] == None:
+            return (handle, mime)
+        optimized = self.cache.get(result["digest"])
+        with optimized.open() as f:
+            optimized = store.put_stream(iter(lambda: f.read(65536), b""))
+        with self.lock:
+            self.saved_bytes += handle.size - optimized.size
+        return (optimized, result["mime"])
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.executor == None:
+                from concurrent.futures import ProcessPoolExecutor
+                self.executor = ProcessPoolExecutor(self.processes)
+        return self.executor.submit(fn, *args)
+
+    def close(self):
+        if self.executor != None:
+            self.executor.shutdown()
+            self.executor = None
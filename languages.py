@@ -0,0 +1,79 @@
+# languages.py: 言語コードの一覧（languages.csv）を引くためのもの。
+#
+# 最初に引かれたときに一度だけ読み込み、カルチャーコード（ja-JPなど）と短い言語コード（ja）のそれぞれをキーにした辞書に持つ。
+# python languages.py でlanguages_frozen.pyを生成しておくと、CSVを読まずにそちらをimportする
+# （languages.csvの方が新しければ無視してCSVを読む）。
+import os
+import csv
+import threading
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "languages.csv")
+FROZEN_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "languages_frozen.py")
+
+_by_culture = None # カルチャーコード → (国, 2文字の国コード, 3文字の国コード, 言語, 2文字の言語コード, 3文字の言語コード, カルチャーコード)
+_by_short = None # 2文字の言語コード → カルチャーコードのリスト
+_lock = threading.Lock()
+
+# languages.csvの行（ヘッダを除く）
+def read_csv():
+    with open(CSV_PATH, 'r') as f:
+        reader = csv.reader(f)
+        next(reader) # ヘッダは無視
+        return [tuple(row) for row in reader]
+
+def read_rows():
+    if os.path.exists(FROZEN_PATH) and os.path.getmtime(FROZEN_PATH) >= os.path.getmtime(CSV_PATH):
+        try:
+            from languages_frozen import LANGUAGES
+            return LANGUAGES
+        except ImportError:
+            pass
+    return read_csv()
+
+def load():
+    global _by_culture, _by_short
+    with _lock:
+        if _by_culture != None:
+            return
+        by_culture = {}
+        by_short = {}
+        for row in read_rows():
+            if not row[6] in by_culture: # 同じカルチャーコードが複数あれば最初のものを使う
+                by_culture[row[6]] = row
+                by_short.setdefault(row[4], []).append(row[6])
+        _by_short = by_short
+        _by_culture = by_culture
+
+# カルチャーコードから2文字の言語コードを引く。無ければNone。
+def short_code(culture_code):
+    if _by_culture == None:
+        load()
+    row = _by_culture.get(culture_code)
+    if row == None:
+        return None
+    return row[4]
+
+# 2文字の言語コードから、それを使うカルチャーコードのリストを引く
+def culture_codes(short_code):
+    if _by_short == None:
+        load()
+    return list(_by_short.get(short_code, []))
+
+def exists(culture_code):
+    return short_code(culture_code) != None
+
+# languages_frozen.pyを生成する
+def freeze(path=FROZEN_PATH):
+    rows = read_csv()
+    tmp = path + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write("# languages.pyがlanguages.csvから生成したもの。編集しないこと。\n")
+        f.write("LANGUAGES = (\n")
+        for row in rows:
+            f.write("    %r,\n" % (row,))
+        f.write(")\n")
+    os.replace(tmp, path)
+    return len(rows)
+
+if __name__ == '__main__':
+    print("wrote %d languages to %s" % (freeze(), FROZEN_PATH))
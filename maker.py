@@ -1,22 +1,176 @@
-import csv
 import os
-import tempfile
 import zipfile
-import genshi
 import datetime
 import uuid
+import copy
+import struct
+import json
+import time
+import zlib
 import shutil
-from genshi.template import TemplateLoader
+import collections
+import contextlib
+import languages
+from genshi.template import TemplateLoader, Context
 from genshi.template.text import NewTextTemplate
 
+# カルチャーコード（ja-JPなど）から2文字の言語コードを引く。無ければNone。
+# languages.csvは最初に一度だけ読み込まれる（languages.pyを参照）。
 def toShortLangcode(long_code):
-	with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'languages.csv'), 'r') as f:
-		reader = csv.reader(f)
-		header = next(reader) # ヘッダは無視
-		for row in reader:
-			if row[6] == long_code:
-				return row[4]
-	return None
+	return languages.short_code(long_code)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "template")
+
+# コンパイル済みのテンプレートのキャッシュ。プロセス全体で共有し、全てのEpubMakerとスレッドから使う。
+# genshiのTemplateLoaderはロックを持っていてスレッドセーフで、テンプレートはファイル名ごとに一度だけパースされる。
+# auto_reloadにしてあるので、ファイルの更新時刻が変わったら読み直す。
+templates = TemplateLoader([TEMPLATE_DIR], auto_reload=True)
+
+# 本を作るのに使うテンプレートを、使われる前にコンパイルしておく
+def precompileTemplates():
+	for filename in ("container.xml", "content.opf", "toc.xhtml", "page.xhtml"):
+		templates.load(filename)
+
+# 環境変数WIKI2EPUB_PRECOMPILE_TEMPLATESが設定されていれば、importしたときにコンパイルしておく
+if os.environ.get("WIKI2EPUB_PRECOMPILE_TEMPLATES"):
+	precompileTemplates()
+
+# シリアライズ済みのページ（addXhtmlPage）を包むXHTML。page.xhtmlをレンダリングした結果と同じ形にする。
+XHTML_PAGE = """<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="%(lang)s" lang="%(lang)s">
+    %(head)s
+    %(body)s
+</html>"""
+
+# ページの中身を取り出す。
+# dataは辞書か、open()でJSONの辞書を返すもの（ディスクに書き出したページ。asset_store.AssetHandleなど）。後者はここで初めて読む。
+def loadPageData(data):
+	if hasattr(data, "open"):
+		with data.open() as f:
+			return json.load(f)
+	return data
+
+# ページをひとつレンダリングする。
+# ctxは本全体で共通のgenshiのContextで、ページごとの値はその上に積んでから取り除く（辞書をまるごとコピーしない）。
+def renderPage(loader, ctx, filename, page):
+	if page.get("xhtml"):
+		data = loadPageData(page["data"])
+		return XHTML_PAGE % {"lang": ctx.get("language_short"), "head": data["head"], "body": data["body"]}
+	frame = dict(page)
+	frame["data"] = loadPageData(page["data"])
+	frame["path"] = 'EPUB/pages/%s.xhtml' % filename
+	ctx.push(frame)
+	try:
+		return loader.load(page["template"]).generate(ctx).render('xhtml')
+	finally:
+		ctx.pop()
+
+# 他のzipのエントリを、展開せずに(ZipInfo, 圧縮済みのデータ)として読み出す
+def readRawZipEntry(src, name):
+	info = src.getinfo(name)
+	with src._lock:
+		src.fp.seek(info.header_offset)
+		header = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+		src.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+		raw = src.fp.read(info.compress_size)
+	return info, raw
+
+# zipのエントリを作って(ZipInfo, 書き込むデータ)を返す。compress_typeはZIP_STOREDかZIP_DEFLATED。
+# dataはstr, bytesか、open()でファイルオブジェクトを返すもの。zlibは圧縮中にGILを手放すので、スレッドで並列に呼べる。
+def makeZipEntry(name, data, compress_type, level=6):
+	if hasattr(data, "open"):
+		with data.open() as f:
+			data = f.read()
+	elif isinstance(data, str):
+		data = data.encode('utf-8')
+	info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+	info.external_attr = 0o600 << 16
+	info.compress_type = compress_type
+	info.CRC = zlib.crc32(data)
+	info.file_size = len(data)
+	if compress_type == zipfile.ZIP_DEFLATED:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+		data = compressor.compress(data) + compressor.flush()
+	info.compress_size = len(data)
+	return info, data
+
+# 無圧縮のエントリを、dataを少しずつ読みながらzipに書き込む。dataはstr, bytesか、open()でファイルオブジェクトを返すもの。
+# 画像などの大きいファイルを、丸ごとメモリに読み込まずに入れるのに使う。
+def writeStoredZipEntry(zipf, name, data):
+	info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+	info.external_attr = 0o600 << 16
+	info.compress_type = zipfile.ZIP_STORED
+	if isinstance(data, str):
+		data = data.encode('utf-8')
+	with zipf.open(info, 'w') as dest:
+		if hasattr(data, "open"):
+			with data.open() as f:
+				shutil.copyfileobj(f, dest)
+		else:
+			dest.write(data)
+
+# 圧縮済みのデータをそのままzipのエントリとして書き込む。infoのcompress_type, CRC, サイズはrawに合わせておくこと。
+def writeRawZipEntry(zipf, info, raw):
+	info = copy.copy(info)
+	info.flag_bits &= ~0x08 # データディスクリプタは使わない
+	with zipf._lock:
+		zipf._writecheck(info)
+		zipf._didModify = True
+		info.header_offset = zipf.fp.tell()
+		zipf.fp.write(info.FileHeader())
+		zipf.fp.write(raw)
+		zipf.start_dir = zipf.fp.tell()
+		zipf.filelist.append(info)
+		zipf.NameToInfo[info.filename] = info
+
+# zipのエントリを、作る（圧縮する）のはスレッドで並列に行い、書き込むのは追加した順番通りに行う。
+# executorがNoneなら追加したときにその場で作って書き込む。メモリに持つのは最大window個まで。
+class ZipEntryWriter:
+	def __init__(self, zipf, executor=None, window=16):
+		self.zipf = zipf
+		self.executor = executor
+		self.window = window
+		self.pending = collections.deque()
+	
+	# job(*args)は(ZipInfo, 書き込むデータ)を返すもの（makeZipEntry, readRawZipEntry）
+	def add(self, job, *args):
+		if self.executor == None:
+			writeRawZipEntry(self.zipf, *job(*args))
+			return
+		self.pending.append(self.executor.submit(job, *args))
+		while len(self.pending) > self.window:
+			writeRawZipEntry(self.zipf, *self.pending.popleft().result())
+	
+	def flush(self):
+		while self.pending:
+			writeRawZipEntry(self.zipf, *self.pending.popleft().result())
+	
+	# 無圧縮のエントリは作るのにCPUを使わないので、スレッドには渡さず、
+	# 先に追加したものを書き込んでから、ここで少しずつ読みながら書き込む（writeStoredZipEntryを参照）
+	def addStored(self, name, data):
+		self.flush()
+		writeStoredZipEntry(self.zipf, name, data)
+
+# 並列にレンダリングするときの、プロセスごとのContextとTemplateLoader
+# loader_optionsがNoneならプロセスごとのtemplatesを、そうでなければそれで作ったTemplateLoaderを使う
+_render_worker = {}
+
+def _initRenderWorker(base, loader_options):
+	_render_worker["ctx"] = Context(**base)
+	_render_worker["loader"] = TemplateLoader(**loader_options) if loader_options != None else templates
+
+def _renderPage(item):
+	return renderPage(_render_worker["loader"], _render_worker["ctx"], item[0], item[1])
+
+# TemplateLoaderを各プロセスで作り直すための引数（loaderがNoneならNone）
+# TemplateLoader自体はロックを持っていてpickleできないので、設定だけを渡す。
+# 設定もpickleできない（search_pathに関数が入っている、callbackがある）ならFalseを返す。
+def loaderOptions(loader):
+	if loader == None:
+		return None
+	if loader.callback != None or any(not isinstance(path, str) for path in loader.search_path):
+		return False
+	return {"search_path": list(loader.search_path), "auto_reload": loader.auto_reload, "default_encoding": loader.default_encoding, "max_cache_size": loader._cache.capacity, "default_class": loader.default_class, "variable_lookup": loader.variable_lookup, "allow_exec": loader.allow_exec}
 
 class EpubMaker:
 	# コンストラクタ
@@ -57,18 +211,59 @@ class EpubMaker:
 		self.default_stylesheet_file = None
 		
 		self.cover_image = None
+		
+		# ページのレンダリングに使うプロセスの数。2以上なら並列にレンダリングする。
+		# 並列になるのはテンプレートを使うページ（addPage）だけで、addXhtmlPageとreusePageのページには効かない。
+		# loaderを各プロセスに渡せない（loaderOptionsを参照）ときは、並列にしない。
+		# 並列のときは、ページのテンプレートからpagesとfilesは参照できない。
+		self.render_processes = 0
+		
+		# テンプレートを読むgenshiのTemplateLoader。Noneならプロセス全体で共有しているもの（templates）を使う。
+		self.loader = None
+		
+		# 圧縮のレベル（zlibの0〜9）。Noneなら全て無圧縮で入れる。
+		self.compress_level = 6
+		
+		# 圧縮しないで入れるファイルのメディアタイプ（既に圧縮されている画像など）
+		self.stored_types = {"image/jpeg", "image/png", "image/gif"}
+		
+		# レンダリングと書き込みにかかった時間を記録するmetrics.Metrics（Noneなら記録しない）
+		self.metrics = None
+		
+		# 圧縮に使うスレッドの数。0ならその場で圧縮する。
+		# レンダリングは呼び出したスレッドで行うので、CPUを一つ残しておく。
+		self.compress_threads = min(4, (os.cpu_count() or 1) - 1)
 	
 	# genshiのxhtml templateからページを作る
+	# dataは辞書か、ディスクに書き出したもの（loadPageDataを参照）。後者ならメモリに持つのはタイトルと順番だけになる。
 	def addPage(self, name, title, data, template="page.xhtml"):
 		self.pages[name] = {"title": title, "data": data, "template": template}
 	
-	# 生データ（バイナリ）を渡してファイルを作る
+	# シリアライズ済みのXHTMLの断片（{"head": "<head>...</head>", "body": "<body>...</body>"}）からページを作る。
+	# genshiでのパースとレンダリングを飛ばすので速いが、断片はXHTMLとして正しくなければならない。
+	# （BeautifulSoupのstr()はHTMLで、<style>の中身などをエスケープしないので使えない。addPageを使うこと）
+	def addXhtmlPage(self, name, title, data):
+		self.pages[name] = {"title": title, "data": data, "xhtml": True}
+	
+	# 前回作ったepub（source）に入っているページをそのまま使う
+	def reusePage(self, name, title, source):
+		self.pages[name] = {"title": title, "source": source}
+	
+	# 生データ（バイナリ）を渡してファイルを作る。
+	# dataはbytesか、open()でファイルオブジェクトを返すもの（asset_store.AssetHandleなど）。後者はepubに書き込むときに読む。
 	def addFile(self, filename, data, type):
 		if filename in self.files:
 			raise(Exception("Filename already exists"));
 		
 		self.files[filename] = {"data": data, "type": type, "id": uuid.uuid4()}
 	
+	# 前回作ったepub（source）に入っているファイルをそのまま使う
+	def reuseFile(self, filename, type, source):
+		if filename in self.files:
+			raise(Exception("Filename already exists"));
+		
+		self.files[filename] = {"type": type, "id": uuid.uuid4(), "source": source}
+	
 	# genshiのtext templateからファイルを作る
 	def addFileFromTemplate(self, filename, data, type, template):
 		if filename in self.files:
@@ -110,67 +305,122 @@ class EpubMaker:
 	#│   │   ├──     .
 	#│   │   ├──     .
 	
+	# メディアタイプのファイルをどう圧縮して入れるか（zipfile.ZIP_STOREDかZIP_DEFLATED）
+	def compressType(self, media_type):
+		if self.compress_level == None or media_type in self.stored_types:
+			return zipfile.ZIP_STORED
+		return zipfile.ZIP_DEFLATED
+	
+	# metricsがあれば、withで囲んだ間の秒数を記録する
+	def timer(self, name):
+		if self.metrics == None:
+			return contextlib.nullcontext()
+		return self.metrics.timer(name)
+	
+	# 一時ディレクトリを使わず、作ったものをそのままzipに書き込んでいく
+	# テキストのエントリの圧縮はcompress_threads個のスレッドで並列に行い、無圧縮のエントリ（画像など）は少しずつ読みながら書き込む
+	# zipは<path>.tmpに書き、できあがってからpathを置き換える。失敗したときはpathにあったもの（前回のepub）がそのまま残る。
+	# reusePage, reuseFileのコピー元がpathでもよい。
+	# metricsには、レンダリングの時間（render_seconds_total）とそれ以外の圧縮と書き込みの時間（zip_seconds_total）を記録する
 	def doMake(self, path):
-		loader = TemplateLoader([os.path.join(os.path.dirname(os.path.realpath(__file__)), "template")])
-		
-		rootdir = tempfile.mkdtemp()
-		print(rootdir)
-		
+		start = time.perf_counter()
+		rendered = self.metrics.get("render_seconds_total") if self.metrics != None else 0
+		tmp = path + ".tmp"
 		try:
-			#File minetype
-			with open(os.path.join(rootdir, 'mimetype'), 'w') as f:
-				f.write('application/epub+zip')
+			if self.compress_threads > 0:
+				from concurrent.futures import ThreadPoolExecutor
+				with ThreadPoolExecutor(self.compress_threads) as executor:
+					self.writeEpub(tmp, executor)
+			else:
+				self.writeEpub(tmp, None)
+		except BaseException:
+			if os.path.exists(tmp):
+				os.remove(tmp)
+			raise
+		os.replace(tmp, path)
+		if self.metrics != None:
+			rendered = self.metrics.get("render_seconds_total") - rendered
+			self.metrics.count("zip_seconds_total", time.perf_counter() - start - rendered)
+			self.metrics.set("epub_bytes", os.path.getsize(path))
+	
+	def writeEpub(self, path, executor):
+		loader = self.loader if self.loader != None else templates
+		level = self.compress_level
+		
+		with zipfile.ZipFile(path, 'w') as zipf:
+			#File minetype (EPUBの決まりで、最初に無圧縮で置く)
+			zipf.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
 			
-			#Directory META-INF/ (container.xml)
-			os.mkdir(os.path.join(rootdir, 'META-INF'))
+			writer = ZipEntryWriter(zipf, executor, self.compress_threads * 4)
 			
-			with open(os.path.join(rootdir, 'META-INF/container.xml'), 'w') as f:
-				f.write(loader.load('container.xml').generate(**self.__dict__).render('xml'))
+			#Directory META-INF/ (container.xml)
+			writer.add(makeZipEntry, 'META-INF/container.xml', loader.load('container.xml').generate(**self.__dict__).render('xml'), self.compressType("application/xml"), level)
 			
 			#Directory OEBPS/ (toc.ncx, content.opf, and xhtml documents)
-			os.mkdir(os.path.join(rootdir, 'EPUB'))
-			
-			with open(os.path.join(rootdir, 'EPUB/content.opf'), 'w') as f:
-				tmp = self.__dict__.copy()
-				tmp.update(self.opf)
-				tmp["path"] = 'EPUB/content.opf'
-				f.write(loader.load(self.opf["template"]).generate(**tmp).render('xml'))
+			tmp = self.__dict__.copy()
+			tmp.update(self.opf)
+			tmp["path"] = 'EPUB/content.opf'
+			writer.add(makeZipEntry, 'EPUB/content.opf', loader.load(self.opf["template"]).generate(**tmp).render('xml'), self.compressType("application/oebps-package+xml"), level)
 			
-			with open(os.path.join(rootdir, 'EPUB/toc.xhtml'), 'w') as f:
-				tmp = self.__dict__.copy()
-				tmp.update(self.toc)
-				tmp["path"] = 'EPUB/toc.xhtml'
-				f.write(loader.load(self.toc["template"]).generate(**tmp).render('xhtml'))
+			tmp = self.__dict__.copy()
+			tmp.update(self.toc)
+			tmp["path"] = 'EPUB/toc.xhtml'
+			writer.add(makeZipEntry, 'EPUB/toc.xhtml', loader.load(self.toc["template"]).generate(**tmp).render('xhtml'), self.compressType("application/xhtml+xml"), level)
 			
-			os.mkdir(os.path.join(rootdir, 'EPUB/pages'))
+			page_compress_type = self.compressType("application/xhtml+xml")
 			
-			for filename, page in self.pages.items():
-				with open(os.path.join(rootdir, 'EPUB/pages/%s.xhtml' % filename), 'w') as f:
-					tmp = self.__dict__.copy()
-					tmp.update(page)
-					tmp["path"] = 'EPUB/pages/%s.xhtml' % filename
-					f.write(loader.load(page["template"]).generate(**tmp).render('xhtml'))
+			# 再利用するページやファイルのコピー元
+			sources = {}
+			def source(path):
+				if not path in sources:
+					sources[path] = zipfile.ZipFile(path)
+				return sources[path]
 			
-			os.mkdir(os.path.join(rootdir, 'EPUB/files'))
-			
-			for filename, file in self.files.items():
-				if "template" in file:
-					with open(os.path.join(rootdir, 'EPUB/files/%s' % filename), 'w') as f:
+			try:
+				loader_options = loaderOptions(self.loader)
+				if self.render_processes > 1 and loader_options != False:
+					from concurrent.futures import ProcessPoolExecutor
+					# テンプレートを使うページは各プロセスでレンダリングし、書き込みはここでページの順番通りに行う
+					# 各プロセスに渡すのでpickleできないもの（loader, metricsのロック）は除く
+					base = dict((k, v) for k, v in self.__dict__.items() if not k in ("pages", "files", "loader", "metrics"))
+					ctx = Context(**base)
+					templated = [item for item in self.pages.items() if not "source" in item[1] and not item[1].get("xhtml")]
+					with ProcessPoolExecutor(self.render_processes, initializer=_initRenderWorker, initargs=(base, loader_options)) as executor:
+						rendered = executor.map(_renderPage, templated, chunksize=16)
+						for filename, page in self.pages.items():
+							if "source" in page:
+								writer.add(readRawZipEntry, source(page["source"]), 'EPUB/pages/%s.xhtml' % filename)
+								continue
+							with self.timer("render_seconds_total"):
+								if page.get("xhtml"):
+									data = renderPage(loader, ctx, filename, page)
+								else:
+									data = next(rendered)
+							writer.add(makeZipEntry, 'EPUB/pages/%s.xhtml' % filename, data, page_compress_type, level)
+				else:
+					ctx = Context(**self.__dict__)
+					for filename, page in self.pages.items():
+						if "source" in page:
+							writer.add(readRawZipEntry, source(page["source"]), 'EPUB/pages/%s.xhtml' % filename)
+						else:
+							with self.timer("render_seconds_total"):
+								data = renderPage(loader, ctx, filename, page)
+							writer.add(makeZipEntry, 'EPUB/pages/%s.xhtml' % filename, data, page_compress_type, level)
+				
+				for filename, file in self.files.items():
+					if "source" in file:
+						writer.add(readRawZipEntry, source(file["source"]), 'EPUB/files/%s' % filename)
+					elif "template" in file:
 						tmp = self.__dict__.copy()
 						tmp.update(file)
 						tmp["path"] = 'EPUB/files/%s' % filename
-						f.write(loader.load(file["template"], cls=NewTextTemplate).generate(**tmp).render('text'))
-				else:
-					with open(os.path.join(rootdir, 'EPUB/files/%s' % filename), 'wb') as f:
-						f.write(file["data"])
-			
-			with zipfile.ZipFile(path, 'w') as zipf:
-				os.chdir(rootdir)
-				for root, dirs, files in os.walk(rootdir):
-					for file in files:
-						zipf.write(os.path.relpath(os.path.join(root, file), rootdir))
-			
-		except Exception as e:
-			raise e
-		finally:
-			shutil.rmtree(rootdir)
\ No newline at end of file
+						writer.add(makeZipEntry, tmp["path"], loader.load(file["template"], cls=NewTextTemplate).generate(**tmp).render('text'), self.compressType(file["type"]), level)
+					elif self.compressType(file["type"]) == zipfile.ZIP_STORED:
+						writer.addStored('EPUB/files/%s' % filename, file["data"])
+					else:
+						writer.add(makeZipEntry, 'EPUB/files/%s' % filename, file["data"], zipfile.ZIP_DEFLATED, level)
+				
+				writer.flush()
+			finally:
+				for z in sources.values():
+					z.close()
\ No newline at end of file
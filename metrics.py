@@ -0,0 +1,144 @@
+# metrics.py: ビルドの計測と、進み具合の出力。
+#
+# 段階ごとの時間、取得にかかった時間の分布、ダウンロードしたバイト数、キャッシュのヒットとミス、
+# 処理したページや捨てたURLの数などを、ビルドごとのMetricsに記録する。
+# 進み具合はevent()で出力する。log_format="text"ならこれまでと同じ文を、"json"なら1行に1つのJSONを出力する。
+# ビルドが終わったら、write_textfile()でPrometheusのtextfile collector向けのファイルに書き出せる。
+#
+# 値には名前とラベル（キーワード引数）を付ける。
+#   count(name, value, **labels)   カウンタ（増えるだけ）
+#   set(name, value, **labels)     ゲージ（最後の値）
+#   observe(name, value, **labels) ヒストグラム（BUCKETSごとの数と合計）
+#   timer(name, **labels)          withで囲んだ間の秒数をカウンタに足す
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+# Prometheusでの名前の接頭辞
+PREFIX = "wiki2epub_"
+
+# ヒストグラムのバケットの上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+
+class Metrics:
+
+    # labels: 全ての値に付けるラベル（{"site": "wikiwiki", "wiki": "sample"}など）
+    # log_format: "text"か"json"
+    def __init__(self, labels={}, log_format="text", stream=None):
+        self.labels = dict(labels)
+        self.log_format = log_format
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.counters = {} # (名前, ラベル) → 値
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def count(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if not key in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.counters.get(self.key(name, labels), 0)
+
+    # 進み具合を出力する。messageはtextのときに出力する文、fieldsはjsonのときに一緒に出力する値。
+    def event(self, event, message, **fields):
+        if self.log_format == "json":
+            record = {"time": time.time(), "event": event}
+            record.update(self.labels)
+            record.update(fields)
+            line = json.dumps(record, ensure_ascii=False, default=str)
+        else:
+            line = message
+        stream = self.stream if self.stream != None else sys.stdout
+        with self.lock:
+            stream.write(line + "\n")
+            stream.flush()
+
+    # 記録した値を、JSONにできる辞書で返す
+    def snapshot(self):
+        def entries(values, convert):
+            return [dict(name=name, labels=dict(labels), **convert(value)) for (name, labels), value in sorted(values.items())]
+        with self.lock:
+            return {
+                "labels": dict(self.labels),
+                "counters": entries(self.counters, lambda value: {"value": value}),
+                "gauges": entries(self.gauges, lambda value: {"value": value}),
+                "histograms": entries(self.histograms, lambda h: {"buckets": dict(zip([str(b) for b in BUCKETS], h.buckets)), "count": h.count, "sum": h.sum}),
+            }
+
+    # Prometheusのテキスト形式
+    def prometheus(self):
+        def format_labels(labels, extra=()):
+            items = list(self.labels.items()) + list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in items) + "}"
+
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted(set(name for name, labels in values)):
+                    lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+                    for (n, labels), value in sorted(values.items()):
+                        if n == name:
+                            lines.append("%s%s%s %r" % (PREFIX, name, format_labels(labels), float(value)))
+            for name in sorted(set(name for name, labels in self.histograms)):
+                lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, number in zip(BUCKETS, h.buckets):
+                        lines.append("%s%s_bucket%s %d" % (PREFIX, name, format_labels(labels, [("le", bound)]), number))
+                    lines.append("%s%s_bucket%s %d" % (PREFIX, name, format_labels(labels, [("le", "+Inf")]), h.count))
+                    lines.append("%s%s_sum%s %r" % (PREFIX, name, format_labels(labels), float(h.sum)))
+                    lines.append("%s%s_count%s %d" % (PREFIX, name, format_labels(labels), h.count))
+        return "\n".join(lines) + "\n"
+
+    # textfile collectorが書きかけのファイルを読まないように、一時ファイルに書いてから置き換える
+    def write_textfile(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
@@ -0,0 +1,107 @@
+# mime_resolver.py: ダウンロードしたファイルのMIMEを決める。
+#
+# 安いものから順に見ていき、決まったところで止める。
+# 1. 先頭の数バイトのシグネチャ（PNG, JPEG, GIFなど。中身そのものなので一番確か）
+# 2. Content-Type（application/octet-streamのような中身のわからないものは無視する）
+# 3. ファイル名やURLの拡張子（extensions.pyのextensions_listから逆引きする）
+# 4. libmagic（python-magic）。先頭のMAGIC_PREFIX bytesだけを渡す。
+# extensions_listは大きいので、拡張子を引くときに初めて読み込む。
+import os
+import threading
+from urllib.parse import urlparse
+
+# libmagicに渡す先頭の長さ
+MAGIC_PREFIX = 8192
+
+# 中身が何かを教えてくれないContent-Type
+GENERIC_TYPES = ("", "application/octet-stream", "binary/octet-stream", "application/x-download", "application/force-download", "text/plain")
+
+# (先頭からの位置, バイト列, MIME)。短くて他と紛れやすいもの（BMPなど）は入れない。
+SIGNATURES = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"wOFF", "font/woff"),
+    (0, b"wOF2", "font/woff2"),
+)
+
+_by_extension = None # 拡張子 → MIME
+_lock = threading.Lock()
+
+def load():
+    global _by_extension
+    with _lock:
+        if _by_extension != None:
+            return
+        from extensions import extensions_list
+        by_extension = {}
+        for mime, extensions in extensions_list.items():
+            for extension in extensions:
+                by_extension.setdefault(extension, mime) # 同じ拡張子が複数あれば最初のものを使う
+        _by_extension = by_extension
+
+# 拡張子（"png"など、ドットは無し）からMIMEを引く。無ければNone。
+def from_extension(extension):
+    if _by_extension == None:
+        load()
+    return _by_extension.get(extension.lower())
+
+# MIMEから拡張子（ドットは無し）を引く。無ければNone。
+def extension_for(mime):
+    from extensions import extensions_list
+    extensions = extensions_list.get(mime)
+    if not extensions:
+        return None
+    return extensions[0]
+
+# 先頭のバイト列のシグネチャからMIMEを決める。わからなければNone。
+def sniff(head):
+    for offset, signature, mime in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if mime == "image/webp" and head[:4] != b"RIFF":
+                continue
+            return mime
+    text = head[:1024].lstrip()
+    if text.startswith(b"<svg") or (text.startswith(b"<?xml") and b"<svg" in text):
+        return "image/svg+xml"
+    return None
+
+# Content-Typeから、パラメータを除いたMIMEを返す。中身がわからないものならNone。
+def from_content_type(content_type):
+    if content_type == None:
+        return None
+    mime = content_type.split(";")[0].strip().lower()
+    if mime in GENERIC_TYPES:
+        return None
+    return mime
+
+# URLかファイル名の拡張子からMIMEを決める
+def from_name(name):
+    extension = os.path.splitext(urlparse(name).path)[1]
+    if extension == "":
+        return None
+    return from_extension(extension[1:])
+
+def from_libmagic(head):
+    try:
+        import magic
+    except ImportError:
+        return None
+    return magic.from_buffer(head[:MAGIC_PREFIX], mime=True)
+
+# head: 中身の先頭, content_type: Content-Typeヘッダ, name: URLかファイル名
+# どれでも決まらなければapplication/octet-streamを返す
+def resolve(head, content_type=None, name=None):
+    mime = sniff(head)
+    if mime == None:
+        mime = from_content_type(content_type)
+    if mime == None and name != None:
+        mime = from_name(name)
+    if mime == None:
+        mime = from_libmagic(head)
+    if mime == None:
+        mime = "application/octet-stream"
+    return mime
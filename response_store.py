@@ -0,0 +1,268 @@
+# response_store.py: URLをキーにしたレスポンスのキャッシュ。
+# vcrのカセット（ひとつのYAMLファイル）の代わりに使う。
+#
+# ディレクトリの構造
+# store
+# ├── index.sqlite     URLのsha256 → ステータスコード, ヘッダ, 本体のsha256
+# └── blobs
+#     ├── 00
+#     │   └── 00f1...   本体（中身のsha256をファイル名にする）
+#     ├── 01
+#     ├──  .
+#
+# 開くときにファイル全体を読み込んだりはしないので、何件入っていてもすぐに開ける。
+# 本体は読まれるまでメモリに載せない。
+#
+# record_mode
+#   "new_episodes": キャッシュにあるものはそれを使い、無いものだけ取得する
+#   "none":         キャッシュにあるものだけを使う（無ければCacheMiss）
+#   "all":          全て取得し直す
+#   "revalidate":   保存してあるETag, Last-Modifiedを付けて条件付きで取得し直す。304ならキャッシュの本体を使う。
+#                   同じ実行の中で確認済みのURLはもう一度確認しない
+# どのモードでも、lookup(url, refresh=True)なら（"none"以外は）その実行で一度は取得し直す。
+import os
+import sys
+import json
+import zlib
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+import collections.abc
+from urllib.parse import urlsplit, urlunsplit
+
+# 保存しないヘッダ。本体は展開済みのものを保存するので、Content-Encodingは意味を持たない。
+DROPPED_HEADERS = ("content-encoding", "transfer-encoding", "content-length")
+
+# record_mode="none"でキャッシュに無いURLが要求されたときの例外
+class CacheMiss(Exception):
+    pass
+
+# URLを正規化する。スキーム無し(//)のURLにはhttp:を付け、ホスト名を小文字にし、フラグメントを捨てる。
+def normalize_url(url):
+    if url.startswith("//"):
+        url = "http:" + url
+    parts = urlsplit(url)
+    netloc = parts.netloc.lower()
+    if parts.scheme == "http" and netloc.endswith(":80"):
+        netloc = netloc[:-3]
+    elif parts.scheme == "https" and netloc.endswith(":443"):
+        netloc = netloc[:-4]
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or "/", parts.query, ""))
+
+def url_key(url):
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+# キーの大文字小文字を区別しない辞書（ヘッダに使う）。requests.structures.CaseInsensitiveDictと同じように使える。
+# キャッシュから読むだけのときにrequestsをimportしなくて済むように、ここで持っておく。
+class CaseInsensitiveDict(collections.abc.MutableMapping):
+
+    def __init__(self, data=None):
+        self._store = {}
+        if data != None:
+            self.update(data)
+
+    def __setitem__(self, key, value):
+        self._store[key.lower()] = (key, value)
+
+    def __getitem__(self, key):
+        return self._store[key.lower()][1]
+
+    def __delitem__(self, key):
+        del self._store[key.lower()]
+
+    def __iter__(self):
+        return (key for key, value in self._store.values())
+
+    def __len__(self):
+        return len(self._store)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+# キャッシュから取り出したレスポンス。requests.Responseのうち、スクレイパーが使う部分だけを真似る。
+class StoredResponse:
+
+    def __init__(self, url, status_code, reason, headers, blob_path):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = CaseInsensitiveDict(headers)
+        self.blob_path = blob_path
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content == None:
+            with open(self.blob_path, 'rb') as f:
+                self._content = f.read()
+        return self._content
+
+    def iter_content(self, chunk_size=65536):
+        if self._content != None:
+            for i in range(0, len(self._content), chunk_size):
+                yield self._content[i:i + chunk_size]
+            return
+        with open(self.blob_path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def close(self):
+        pass
+
+class ResponseStore:
+
+    # (ディレクトリのパス, "new_episodes"/"none"/"all"/"revalidate", ホストごとのレート, バースト)
+    def __init__(self, path, record_mode="new_episodes", rate=None, burst=None):
+        self.path = path
+        self.record_mode = record_mode
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.checked = set() # この実行で取得または確認したURLのキー
+        os.makedirs(os.path.join(path, "blobs"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status INTEGER, reason TEXT, headers TEXT, blob TEXT, size INTEGER, fetched REAL)")
+        self.db.commit()
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, "blobs", digest[:2], digest)
+
+    # キャッシュからレスポンスを取り出す。無ければNone。
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT url, status, reason, headers, blob FROM responses WHERE key = ?", (url_key(url),)).fetchone()
+        if row == None:
+            return None
+        return StoredResponse(row[0], row[1], row[2], json.loads(row[3]), self.blob_path(row[4]))
+
+    # record_modeに従ってキャッシュを引く。ネットワークから取ってくるべきときはNoneを返す。
+    # refresh=Trueなら、この実行でまだ取得していないURLは（record_mode="none"でなければ）取得し直させる。
+    def lookup(self, url, refresh=False):
+        if self.record_mode == "all":
+            return None
+        if (refresh or self.record_mode == "revalidate") and self.record_mode != "none" and not url_key(url) in self.checked:
+            return None
+        obj = self.get(url)
+        if obj == None and self.record_mode == "none":
+            raise CacheMiss("not in the response store: " + url)
+        return obj
+
+    # 本体をchunksから読みながらblobに書き出し、インデックスに登録する
+    def put(self, url, status_code, reason, headers, chunks):
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.path, "blobs"))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+            blob = self.blob_path(digest)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if os.path.exists(blob):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, blob)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        headers = dict((k, v) for k, v in headers.items() if not k.lower() in DROPPED_HEADERS)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (url_key(url), normalize_url(url), status_code, reason, json.dumps(headers), digest, size, time.time()))
+            self.db.commit()
+            self.checked.add(url_key(url))
+        return StoredResponse(normalize_url(url), status_code, reason, headers, blob)
+
+    # requests.Responseを保存する
+    def put_response(self, url, obj):
+        return self.put(url, obj.status_code, obj.reason, obj.headers, obj.iter_content(65536))
+    
+    # 条件付きリクエストに付けるヘッダ。revalidateでないか、キャッシュに使える本体が無ければ空の辞書。
+    def conditional_headers(self, url):
+        if self.record_mode != "revalidate":
+            return {}
+        obj = self.get(url)
+        if obj == None or obj.status_code != 200:
+            return {}
+        headers = {}
+        if "ETag" in obj.headers:
+            headers["If-None-Match"] = obj.headers["ETag"]
+        if "Last-Modified" in obj.headers:
+            headers["If-Modified-Since"] = obj.headers["Last-Modified"]
+        return headers
+    
+    # 304 Not Modifiedが返ってきたら呼ぶ。キャッシュのヘッダを304のヘッダで更新し、キャッシュのレスポンスを返す。
+    def refresh(self, url, headers):
+        obj = self.get(url)
+        obj.headers.update((k, v) for k, v in headers.items() if not k.lower() in DROPPED_HEADERS)
+        with self.lock:
+            self.db.execute("UPDATE responses SET headers = ?, fetched = ? WHERE key = ?", (json.dumps(dict(obj.headers)), time.time(), url_key(url)))
+            self.db.commit()
+            self.checked.add(url_key(url))
+        return obj
+
+    # 保存されている全てのレスポンス
+    def responses(self):
+        with self.lock:
+            rows = self.db.execute("SELECT url, status, reason, headers, blob FROM responses ORDER BY fetched").fetchall()
+        for row in rows:
+            yield StoredResponse(row[0], row[1], row[2], json.loads(row[3]), self.blob_path(row[4]))
+
+    # 保存されているレスポンスの数
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # vcrのカセットを読み込んでストアに移す。取り込んだ件数を返す。
+    def import_cassette(self, path):
+        from vcr.serialize import deserialize
+        from vcr.serializers import yamlserializer
+
+        with open(path, 'r') as f:
+            requests, responses = deserialize(f.read(), yamlserializer)
+
+        for request, response in zip(requests, responses):
+            headers = dict((k, ", ".join(v) if isinstance(v, list) else v) for k, v in response["headers"].items())
+            body = response["body"]["string"]
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            body = decode_body(body, CaseInsensitiveDict(headers).get("Content-Encoding", ""))
+            self.put(request.uri, response["status"]["code"], response["status"]["message"], headers, [body])
+
+        return len(requests)
+
+# カセットにはサーバから来た生の本体が入っているので、圧縮されていたら展開する
+def decode_body(body, encoding):
+    encoding = encoding.strip().lower()
+    if encoding == "gzip":
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    if encoding == "br":
+        import brotli
+        return brotli.decompress(body)
+    return body
+
+if __name__ == '__main__':
+    # python response_store.py <カセットのパス> <ストアのディレクトリ>
+    store = ResponseStore(sys.argv[2])
+    print("imported %d responses" % store.import_cassette(sys.argv[1]))
+    store.close()
@@ -0,0 +1,174 @@
+# rewriter.py: ページ内のhrefやsrcを、epub内のパスに書き換える。
+#
+# どのURLをどのパスにするか（とダウンロードするかどうか）はスクレイパーのclassify_href, classify_srcが決める。
+# 結果はURLごとに覚えておくので、同じURLの判定とsha256の計算はクロール全体で一度だけになる。
+import re
+import hashlib
+import lxml.html
+from lxml import etree
+from bs4 import BeautifulSoup
+
+# 書き換えの対象になる属性
+TARGET_ATTRS = ("href", "src", "style", "onclick")
+
+DISPLAY_NONE_RE = re.compile(r"display\s*:\s*none")
+
+# lxmlで、scriptタグと書き換えの対象になる属性を持つ要素を文書の順に集める
+TARGET_XPATH = etree.XPath("//script | //*[@href or @src or @style or @onclick]")
+
+# ページに追加するスタイルシート
+STYLESHEET = {"rel": "stylesheet", "href": "../files/style.css", "type": "text/css"}
+
+# 要素の属性を書き換える。lxmlの要素とBeautifulSoupの要素の両方に使える。
+def set_attribute(element, attr, value):
+    if isinstance(element, etree._Element):
+        element.set(attr, value)
+    else:
+        element[attr] = value
+
+class LinkRewriter:
+
+    def __init__(self, scraper):
+        self.scraper = scraper
+        self.digests = {}
+        self.hrefs = {}
+        self.srcs = {}
+
+    # URLのsha256（16進数）
+    def digest(self, url):
+        ret = self.digests.get(url)
+        if ret == None:
+            ret = self.digests[url] = hashlib.sha256(url.encode()).hexdigest()
+        return ret
+
+    # hrefの書き換え先と、ダウンロードするファイル（(ファイル名, MIMEの決め方, MIME) または None）
+    def href(self, url):
+        ret = self.hrefs.get(url)
+        if ret == None:
+            ret = self.hrefs[url] = self.scraper.classify_href(url)
+        return ret
+
+    def src(self, url):
+        ret = self.srcs.get(url)
+        if ret == None:
+            ret = self.srcs[url] = self.scraper.classify_src(url)
+        return ret
+
+    # scriptタグか、書き換えの対象になる属性を持つ要素かどうか
+    @staticmethod
+    def is_target(element):
+        if element.name == "script":
+            return True
+        attrs = element.attrs
+        for attr in TARGET_ATTRS:
+            if attr in attrs:
+                return True
+        return False
+
+    # ページの本体をBeautifulSoupで処理して、(タイトル, {"head": ..., "body": ...})を返す
+    def process_bs4(self, body):
+        page = BeautifulSoup(body, "lxml")
+
+        self.rewrite(page)
+
+        self.scraper.finish_downloads()
+
+        page.head.append(page.new_tag('link', **STYLESHEET))
+
+        return (page.title.text, {"head": str(page.head), "body": str(page.body)})
+
+    # ページの本体をlxmlで処理して、(タイトル, {"head": ..., "body": ...})を返す。
+    # BeautifulSoupの木を作らないぶん速く、メモリも少なくて済む。head, bodyはXHTMLとしてシリアライズする。
+    def process_lxml(self, body):
+        root = lxml.html.document_fromstring(body)
+
+        for element in TARGET_XPATH(root):
+            self.process_lxml_element(element)
+
+        self.scraper.finish_downloads()
+
+        head = root.find("head")
+        if head == None:
+            head = etree.Element("head")
+            root.insert(0, head)
+        etree.SubElement(head, "link", STYLESHEET)
+
+        title = head.find("title")
+
+        return (title.text_content() if title != None else "", {"head": serialize_xhtml(head), "body": serialize_xhtml(root.find("body"))})
+
+    # BeautifulSoupの文書を書き換える。対象になる要素だけを一度の走査で集めて処理する。
+    def rewrite(self, page):
+        for element in page.find_all(self.is_target):
+            self.process_element(element)
+
+    # lxmlの要素をひとつ処理する。やることはprocess_elementと同じ。
+    def process_lxml_element(self, element):
+
+        if element.tag == "script": # scriptタグは問答無用で削除
+            element.drop_tree()
+            return
+
+        attrib = element.attrib
+
+        if attrib.get("onclick"):
+            del attrib["onclick"] # onclickは問答無用で削除
+
+        if self.scraper.strip_display_none and attrib.get("style"):
+            attrib["style"] = DISPLAY_NONE_RE.sub("", attrib["style"])
+
+        href = attrib.get("href")
+
+        if href and not href.startswith("#"):
+            path, asset = self.href(href)
+            attrib["href"] = path
+            if asset != None:
+                self.scraper.defer(self.scraper.download(href, *asset), element, "href")
+
+        src = attrib.get("src")
+
+        if src:
+            path, asset = self.src(src)
+            attrib["src"] = path
+            if asset != None:
+                self.scraper.defer(self.scraper.download(src, *asset), element, "src")
+
+    # 要素をひとつ処理する。
+    # 処理その１：scriptタグだったりしたら要素自体を消す、などの検閲作業
+    # 処理その２：cssやimgのURLをepub内のものに置き換える(sha256する)
+    # 処理その３：画像ファイルやcssなどのダウンロードを予約する
+    def process_element(self, element):
+
+        if element.name == "script": # scriptタグは問答無用で削除
+            element.extract()
+            return
+
+        if element.get("onclick"):
+            del element["onclick"] # onclickは問答無用で削除
+
+        if self.scraper.strip_display_none and element.get("style"):
+            element["style"] = DISPLAY_NONE_RE.sub("", element.get("style")) # display:noneがありすぎるとkindlegenでエラーが出るので・・・・
+
+        # href属性関連
+        href = element.get("href")
+
+        if href and not href.startswith("#"):
+            path, asset = self.href(href)
+            element["href"] = path
+            if asset != None:
+                self.scraper.defer(self.scraper.download(href, *asset), element, "href")
+
+        # src属性関連
+        src = element.get("src")
+
+        if src:
+            path, asset = self.src(src)
+            element["src"] = path
+            if asset != None:
+                self.scraper.defer(self.scraper.download(src, *asset), element, "src")
+
+# lxmlの要素をXHTMLの断片としてシリアライズする。名前空間は包む側のhtml要素で宣言する。
+def serialize_xhtml(element):
+    if element == None:
+        return ""
+    return etree.tostring(element, method="xml", encoding="unicode", with_tail=False)
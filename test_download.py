@@ -0,0 +1,127 @@
+# test_download.py: ダウンロードの回帰テスト。bench_site.pyの偽のwikiをローカルで立てて、実際にビルドする。
+#
+# python -m unittest test_download
+import os
+import io
+import re
+import random
+import shutil
+import struct
+import zlib
+import zipfile
+import tempfile
+import threading
+import unittest
+import contextlib
+import bench_site
+from wikiwiki_scraper import WikiwikiScraper
+
+# ページ0に、404になる画像がある偽のwiki
+class MissingImageWiki(bench_site.SyntheticWiki):
+
+    def __init__(self):
+        bench_site.SyntheticWiki.__init__(self, "wikiwiki", pages=3, images_per_page=2, css_files=1, paragraphs=2)
+
+    def page(self, i):
+        html = bench_site.SyntheticWiki.page(self, i)
+        if i == 0:
+            html = html.replace('<div id="body">', '<div id="body"><img src="/missing.png" alt="missing">')
+        return html
+
+# 画像が写真のような（色の多い）PNGの偽のwiki
+class PhotoWiki(bench_site.SyntheticWiki):
+
+    def __init__(self):
+        bench_site.SyntheticWiki.__init__(self, "wikiwiki", pages=2, images_per_page=2, css_files=1, paragraphs=2)
+
+    def image(self, k):
+        size = self.image_size
+        noise = random.Random(k)
+        raw = b"".join(b"\x00" + bytes(noise.randrange(256) for x in range(size * 3)) for y in range(size))
+        def chunk(kind, data):
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+        return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+def has_pillow():
+    try:
+        import PIL
+    except ImportError:
+        return False
+    return True
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="wiki2epub-test-")
+        self.server = None
+
+    def tearDown(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def serve(self, site):
+        self.site = site
+        self.server = bench_site.create_server(site)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def create_scraper(self):
+        scraper = WikiwikiScraper(bench_site.WIKI_ID, "test")
+        scraper.rooturl = self.site.root
+        scraper.base_url = self.site.base_url()
+        scraper.request_rate = 1000000
+        scraper.request_burst = 1000000
+        return scraper
+
+    # スレッドプールを使わない（その場でダウンロードする）ときに、404で止まらないこと
+    def test_not_found_without_executor(self):
+        self.serve(MissingImageWiki())
+        scraper = self.create_scraper()
+        scraper.workers = 0
+        path = os.path.join(self.workdir, "test.epub")
+        errors = []
+
+        def build():
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    scraper.make(path, os.path.join(self.workdir, "store"))
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=build, daemon=True)
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), "the build hung on a 404")
+        self.assertEqual(errors, [])
+        self.assertEqual(scraper.metrics.get("not_found_total"), 1)
+        self.assertEqual(len(scraper.pages), 3)
+        with zipfile.ZipFile(path) as zipf:
+            self.assertEqual(len([name for name in zipf.namelist() if name.startswith("EPUB/files/") and name.endswith(".png")]), self.site.images)
+
+    # JPEGにしたPNGは、拡張子もJPEGのものに変わり、ページとcontent.opfがそれを参照すること
+    @unittest.skipUnless(has_pillow(), "Pillow is not installed")
+    def test_converted_images_are_renamed(self):
+        self.serve(PhotoWiki())
+        scraper = self.create_scraper()
+        scraper.image_profile = "eink"
+        scraper.image_processes = 1
+        path = os.path.join(self.workdir, "test.epub")
+        with contextlib.redirect_stdout(io.StringIO()):
+            scraper.make(path, os.path.join(self.workdir, "store"))
+        with zipfile.ZipFile(path) as zipf:
+            names = [name[len("EPUB/files/"):] for name in zipf.namelist() if name.startswith("EPUB/files/")]
+            images = [name for name in names if not name.endswith(".css")]
+            self.assertEqual(len(images), self.site.images)
+            for name in images:
+                self.assertTrue(name.endswith(".jpeg"), name)
+            opf = zipf.read("EPUB/content.opf").decode("utf-8")
+            for name in images:
+                self.assertRegex(opf, r'href="files/%s"[^>]*media-type="image/jpeg"' % re.escape(name))
+            for name in zipf.namelist():
+                if name.startswith("EPUB/pages/"):
+                    for filename in re.findall(r'"\.\./files/([^"]+)"', zipf.read(name).decode("utf-8")):
+                        self.assertIn(filename, names)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# test_incremental.py: 差分ビルドの回帰テスト。bench_site.pyの偽のwikiをローカルで立てて、実際にビルドする。
+#
+# python -m unittest test_incremental
+import os
+import io
+import re
+import shutil
+import zipfile
+import tempfile
+import threading
+import unittest
+import contextlib
+import bench_site
+from wikiwiki_scraper import WikiwikiScraper
+
+FILE_RE = re.compile(r'"\.\./files/([^"]+)"')
+
+# 画像の中身が3種類しかない（中身が同じで名前の違う画像がある）偽のwiki。
+# changedにすると、ページ0の画像の順番が変わり、前回は他のページが使っていた名前の画像がまとめられる側になる。
+class RepeatingWiki(bench_site.SyntheticWiki):
+
+    def __init__(self):
+        bench_site.SyntheticWiki.__init__(self, "wikiwiki", pages=10, images_per_page=4, images=12, css_files=1, paragraphs=2)
+        self.changed = False
+
+    def image(self, k):
+        return bench_site.SyntheticWiki.image(self, k % 3)
+
+    def page(self, i):
+        html = bench_site.SyntheticWiki.page(self, i)
+        if i == 0 and self.changed:
+            html = html.replace('<img src="/img/3.png" alt="figure">', "").replace('<img src="/img/0.png"', '<img src="/img/3.png" alt="figure"><img src="/img/0.png"')
+        return html
+
+class IncrementalBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="wiki2epub-test-")
+        self.site = RepeatingWiki()
+        self.server = bench_site.create_server(self.site)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def build(self, record_mode):
+        scraper = WikiwikiScraper(bench_site.WIKI_ID, "test")
+        scraper.rooturl = self.site.root
+        scraper.base_url = self.site.base_url()
+        scraper.request_rate = 1000000
+        scraper.request_burst = 1000000
+        with contextlib.redirect_stdout(io.StringIO()):
+            scraper.make(os.path.join(self.workdir, "test.epub"), os.path.join(self.workdir, "store"), record_mode=record_mode, incremental=True)
+        return scraper
+
+    # ページが参照しているファイルが全てepubに入っているか
+    def assertNoMissingFiles(self):
+        with zipfile.ZipFile(os.path.join(self.workdir, "test.epub")) as zipf:
+            names = set(zipf.namelist())
+            for name in names:
+                if name.startswith("EPUB/pages/"):
+                    for filename in FILE_RE.findall(zipf.read(name).decode("utf-8")):
+                        self.assertIn("EPUB/files/" + filename, names, "%s refers to a missing file" % name)
+
+    def test_reused_pages_keep_deduplicated_files(self):
+        self.build("new_episodes")
+        self.assertNoMissingFiles()
+
+        self.site.changed = True
+        scraper = self.build("all")
+        self.assertEqual(scraper.metrics.get("pages_total", state="reused"), len(scraper.pageurls) - 1)
+        self.assertNoMissingFiles()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
 # webutil.py: 主にwebアクセス関連の便利な関数群。
-import requests
-import vcr
+# requestsとvcrは重いので、実際にネットワークやカセットを使うときにimportする。
 import os
 import time
+import threading
+import collections
+import random
+import contextlib
+from urllib.parse import urlparse
+from response_store import ResponseStore
 
 def script_path(*args):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), *args)
@@ -13,11 +18,309 @@ def get_local_file(path):
         ret = f.read()
     return ret
 
+# HTTPセッションの設定。
+# 全てのスレッドでひとつの接続プールを共有し、同じホストへの接続はkeep-aliveで使い回す。
+pool_connections = 16 # 接続プールを持っておくホストの数
+pool_maxsize = 32 # ホストごとに使い回す接続の数
+timeout = (10, 60) # (接続, 読み込み)のタイムアウト（秒）
+retries = 3 # 一時的なエラーのときに再試行する回数
+backoff_factor = 0.5 # 再試行までの待ち時間の基準（秒）
+retry_status = (429, 500, 502, 503, 504) # 再試行するステータスコード
+compression = "gzip" # "br"にするとbrotliにも対応していれば受け付ける。Noneなら圧縮しない
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_generation = 0
+_local = threading.local()
+
+# urllib3がbrotliを展開できるかどうか
+def brotli_supported():
+    try:
+        from requests.packages.urllib3 import response
+    except ImportError:
+        return False
+    return getattr(response, "brotli", None) != None
+
+def accept_encoding():
+    if compression == None:
+        return "identity"
+    if compression == "br" and brotli_supported():
+        return "gzip, deflate, br"
+    return "gzip, deflate"
+
+# 設定を変えたあとに呼ぶと、次のリクエストから新しい接続プールが使われる
+def reset_sessions():
+    global _adapter, _generation
+    with _adapter_lock:
+        if _adapter != None:
+            _adapter.close()
+        _adapter = None
+        _generation += 1
+
+def shared_adapter():
+    global _adapter
+    with _adapter_lock:
+        if _adapter == None:
+            import requests.adapters
+            _adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        return _adapter
+
+# スレッドごとのセッションを返す。
+# requests.Sessionはスレッドセーフではないのでスレッドごとに作るが、接続プール（アダプタ）は共有する。
+def get_session():
+    session = getattr(_local, "session", None)
+    if session == None or _local.generation != _generation:
+        import requests
+        session = requests.Session()
+        adapter = shared_adapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Accept-Encoding"] = accept_encoding()
+        _local.session = session
+        _local.generation = _generation
+    return session
+
+# 再試行までの待ち時間。Retry-Afterがあればそれに従い、なければ指数的に増やしてゆらぎを加える。
+def retry_delay(attempt, retry_after=None):
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+# metricsがあればそちらに、無ければprintで進み具合を出力する
+def report(metrics, event, message, **fields):
+    if metrics != None:
+        metrics.event(event, message, **fields)
+    else:
+        print(message)
+
 # インターネットからファイルを取得する。
-def get_global_file_as_object(url):
+# storeにResponseStoreを渡すと、キャッシュにあるものはそこから返し、無いものは取得してから保存する。
+# stream=Trueなら本体をまだ読み込まずに返すので、iter_contentで少しずつ読める。
+# storeのrecord_modeが"revalidate"なら条件付きで取得し、304ならキャッシュにある本体を返す。
+# refresh=Trueなら、キャッシュにあってもこの実行で一度は取得し直す（更新されたとわかっているページなど）。
+# metrics（metrics.Metrics）を渡すと、キャッシュのヒットとミス、レート制限で待った時間、取得にかかった時間、
+# ダウンロードしたバイト数を記録する。
+def get_global_file_as_object(url, store=None, stream=False, refresh=False, metrics=None):
     if url.startswith("//"):
         url = "http:" + url
-    return requests.get(url)
+    if store == None:
+        start = time.perf_counter()
+        obj = request_with_retries(url, stream, metrics=metrics)
+        if metrics != None:
+            metrics.observe("fetch_seconds", time.perf_counter() - start)
+        return obj
+    obj = store.lookup(url, refresh)
+    if obj != None:
+        if metrics != None:
+            metrics.count("cache_hits_total")
+        return obj
+    headers = store.conditional_headers(url)
+    start = time.perf_counter()
+    limiter.acquire(urlparse(url).hostname, store.rate, store.burst)
+    if metrics != None:
+        metrics.count("cache_misses_total")
+        metrics.count("rate_limit_wait_seconds_total", time.perf_counter() - start)
+    start = time.perf_counter()
+    obj = request_with_retries(url, True, headers, metrics)
+    if obj.status_code == 304 and headers:
+        obj.close()
+        obj = store.refresh(url, obj.headers)
+        if metrics != None:
+            metrics.count("not_modified_total")
+            metrics.observe("fetch_seconds", time.perf_counter() - start)
+        return obj
+    obj = store.put_response(url, obj)
+    if metrics != None:
+        metrics.observe("fetch_seconds", time.perf_counter() - start) # 本体を読み終わるまで
+        metrics.count("downloaded_bytes_total", os.path.getsize(obj.blob_path))
+    return obj
+
+# 接続エラーやタイムアウト、retry_statusのレスポンスはretries回まで再試行する。
+# 再試行もホストのレート制限（429や503で落としたレート）に従い、一回ごとにトークンを取る。
+# headersはリクエストに追加するヘッダ。
+def request_with_retries(url, stream=False, headers=None, metrics=None):
+    import requests
+    host = urlparse(url).hostname
+    obj = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            start = time.perf_counter()
+            limiter.acquire(host)
+            if metrics != None:
+                metrics.count("rate_limit_wait_seconds_total", time.perf_counter() - start)
+        try:
+            if _cassettes > 0:
+                with cassette_lock:
+                    obj = get_session().get(url, headers=headers, timeout=timeout, stream=stream)
+            else:
+                obj = get_session().get(url, headers=headers, timeout=timeout, stream=stream)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay(attempt)
+            if metrics != None:
+                metrics.count("retries_total", reason="error")
+            report(metrics, "retry", "retrying (" + str(e) + "): " + url, url=url, error=str(e))
+        except Exception:
+            # 再試行がカセットなどに拒まれたら、最後に受け取ったレスポンスを返す
+            if obj != None:
+                return obj
+            raise
+        else:
+            limiter.observe(host, obj.status_code, obj.headers.get("Retry-After"))
+            if metrics != None:
+                metrics.count("responses_total", status=str(obj.status_code))
+            if not obj.status_code in retry_status or attempt == retries:
+                return obj
+            delay = retry_delay(attempt, obj.headers.get("Retry-After"))
+            obj.content # 接続をプールに返すために読み切っておく
+            if metrics != None:
+                metrics.count("retries_total", reason="status")
+            report(metrics, "retry", "retrying (status " + str(obj.status_code) + "): " + url, url=url, status=obj.status_code)
+        time.sleep(delay)
+    return obj
+
+def get_global_file(url, store=None, refresh=False):
+    return get_global_file_as_object(url, store, refresh=refresh).content
+
+# ホストごとのトークンバケット。
+# rate: 1秒あたりに補充されるトークン数, burst: 溜めておけるトークンの最大数
+class TokenBucket:
+    
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+    
+    # トークンを一つ予約し、使えるようになるまでの秒数を返す
+    def reserve(self, now):
+        if now < self.blocked_until:
+            now_ = self.blocked_until
+        else:
+            now_ = now
+        self.tokens = min(self.burst, self.tokens + (now_ - self.updated) * self.rate)
+        self.updated = now_
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return now_ - now
+        return now_ - now - self.tokens / self.rate
+    
+    # 429や503が返ってきたら、レートを半分にしてしばらく止める
+    def backoff(self, now, retry_after=None):
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after != None else 1 / self.rate))
+    
+    # 成功したら、レートを少しずつ元に戻す
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+# ホストごとにトークンバケットを持つレート制限器。
+# 初めて見るホストのバケットは、acquireに渡されたレートかデフォルトのレートで作られる。
+class RateLimiter:
+    
+    def __init__(self, rate=1, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+    
+    def bucket(self, host, rate=None, burst=None):
+        if not host in self.buckets:
+            self.buckets[host] = TokenBucket(rate or self.rate, burst or self.burst)
+        return self.buckets[host]
+    
+    # ホストのレートとバーストを設定する
+    def configure(self, host, rate, burst=1):
+        with self.lock:
+            self.buckets[host] = TokenBucket(rate, burst)
+    
+    # トークンが使えるようになるまで待つ
+    def acquire(self, host, rate=None, burst=None):
+        with self.lock:
+            wait = self.bucket(host, rate, burst).reserve(time.monotonic())
+        if wait > 0:
+            time.sleep(wait)
+    
+    # レスポンスのステータスコードを見てレートを調整する
+    def observe(self, host, status_code, retry_after=None):
+        with self.lock:
+            if not host in self.buckets:
+                return
+            if status_code in (429, 503):
+                try:
+                    retry_after = float(retry_after)
+                except (TypeError, ValueError):
+                    retry_after = None
+                self.buckets[host].backoff(time.monotonic(), retry_after)
+            elif status_code < 400:
+                self.buckets[host].recover()
+
+limiter = RateLimiter()
+
+# vcrのカセットの_before_record_requestに入れる関数を作る。
+# カセットに記録済みのリクエストは(メソッド, URI)の集合で覚えておき、新しいリクエストのときだけレート制限をかける。
+# （match_onとは関係なく、メソッドとURIが同じなら記録済みとみなす）
+# vcrはひとつのリクエストに対して何度もこの関数を呼ぶが、待つのは最初の一回だけ。
+def rate_limit_hook(cassette, rate=None, burst=None):
+    def request_key(request):
+        return (request.method, request.uri)
+    
+    recorded = set(map(request_key, cassette.requests))
+    
+    def hook(request):
+        key = request_key(request)
+        if not key in recorded:
+            recorded.add(key)
+            limiter.acquire(request.host, rate, burst)
+        return request
+    
+    return hook
+
+# vcrは複数のスレッドから同時に記録すると、記録中に一時的にパッチを外すせいでリクエストを取りこぼす。
+# なので、カセットを使っている間はリクエストを直列にする。
+cassette_lock = threading.Lock()
+_cassettes = 0
+
+# vcr.use_cassetteにレート制限を付けたもの
+@contextlib.contextmanager
+def use_cassette(path, record_mode, match_on, rate=None, burst=None):
+    global _cassettes
+    import vcr
+    with vcr.use_cassette(path, record_mode=record_mode, match_on=match_on) as cassette:
+        cassette._before_record_request = rate_limit_hook(cassette, rate, burst)
+        _cassettes += 1
+        try:
+            yield cassette
+        finally:
+            _cassettes -= 1
+
+# レスポンスのキャッシュを使う。
+# pathが既存のファイルならvcrのカセットとして扱い（Noneを返す）、そうでなければResponseStoreのディレクトリとして開いて返す。
+@contextlib.contextmanager
+def use_cache(path, record_mode, match_on, rate=None, burst=None):
+    if os.path.isfile(path):
+        if record_mode == "revalidate":
+            raise(Exception("record_mode=\"revalidate\" needs a response store, not a vcr cassette"))
+        with use_cassette(path, record_mode, match_on, rate, burst):
+            yield None
+    else:
+        store = ResponseStore(path, record_mode, rate, burst)
+        try:
+            yield store
+        finally:
+            store.close()
 
-def get_global_file(url):
-    return get_global_file_as_object(url).content
\ No newline at end of file
+# executor上でfuncをitemsの各要素に適用し、結果を順番通りに返す。
+# 先読みするのはwindow個までなので、メモリに溜まる結果の数も抑えられる。
+def map_bounded(executor, func, items, window):
+    futures = collections.deque()
+    for item in items:
+        futures.append(executor.submit(func, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
@@ -0,0 +1,104 @@
+# wiki2epub.py: wikiをepubにするコマンド。
+#
+# python wiki2epub.py crawl wikiwiki <wiki_id> <epub> <キャッシュ>
+# python wiki2epub.py crawl atwiki <wiki_id> <epub> <キャッシュ> --server <サーバ番号>
+# python wiki2epub.py rebuild ...            キャッシュだけから作り直す（*_rebuild.pyと同じ）
+# python wiki2epub.py rebuild-page-only ...  ダウンロードしたファイルを入れずに作り直す
+# python wiki2epub.py batch <マニフェスト> [サマリ]
+#
+# 起動を速くするため、スクレイパー（bs4, genshi, lxmlなど）はコマンドを実行するときに初めてimportする。
+# --helpや引数の間違いでは何もimportしない。
+import sys
+import argparse
+
+def create_scraper(args):
+    if args.site == "atwiki":
+        if args.server == None:
+            raise(SystemExit("atwiki needs --server"))
+        from atwiki_scraper import AtwikiScraper
+        scraper = AtwikiScraper(args.server, args.wiki_id, args.book_id)
+    else:
+        from wikiwiki_scraper import WikiwikiScraper
+        scraper = WikiwikiScraper(args.wiki_id, args.book_id)
+    if args.workers != None:
+        scraper.workers = args.workers
+    if args.parser != None:
+        scraper.parser = args.parser
+    if args.render_processes != None:
+        scraper.render_processes = args.render_processes
+    if args.image_profile != None:
+        scraper.image_profile = args.image_profile
+    if args.compress_level != None:
+        scraper.compress_level = args.compress_level if args.compress_level >= 0 else None
+    scraper.log_format = args.log_format
+    scraper.metrics_path = args.metrics_file
+    return scraper
+
+def crawl(args):
+    scraper = create_scraper(args)
+    scraper.make(args.epub, args.cache, record_mode=args.record_mode, incremental=args.incremental, delta=args.delta, resume=args.resume)
+
+def rebuild(args):
+    scraper = create_scraper(args)
+    scraper.make(args.epub, args.cache, record_mode="none", incremental=True, resume=args.resume)
+
+def rebuild_page_only(args):
+    scraper = create_scraper(args)
+    scraper.page_only = True
+    scraper.make(args.epub, args.cache, record_mode="none", incremental=True, resume=args.resume)
+
+def run_batch(args):
+    import batch
+    status = batch.run_manifest(args.manifest, args.summary)
+    if status:
+        sys.exit(status)
+
+def add_build_arguments(parser):
+    parser.add_argument("site", choices=("wikiwiki", "atwiki"))
+    parser.add_argument("wiki_id")
+    parser.add_argument("epub", help="path to the epub file to make")
+    parser.add_argument("cache", help="response store directory or vcr cassette")
+    parser.add_argument("--server", type=int, help="atwiki server number (www<N>.atwiki.jp)")
+    parser.add_argument("--book-id")
+    parser.add_argument("--workers", type=int, help="download threads")
+    parser.add_argument("--parser", choices=("bs4", "lxml"))
+    parser.add_argument("--render-processes", type=int, help="processes rendering pages through the template (--parser bs4 only)")
+    parser.add_argument("--image-profile", choices=("eink", "tablet"), help="shrink images for e-readers (needs Pillow)")
+    parser.add_argument("--compress-level", type=int, help="zlib level for text entries (-1 to store everything)")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted build")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text", help="json prints one event per line")
+    parser.add_argument("--metrics-file", help="write build metrics in the Prometheus textfile format")
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="wiki2epub", description="make an epub file from a wiki")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    command = commands.add_parser("crawl", help="crawl a wiki and make an epub")
+    add_build_arguments(command)
+    command.add_argument("--record-mode", default="new_episodes", choices=("new_episodes", "none", "all", "revalidate"))
+    command.add_argument("--incremental", action="store_true", help="reuse unchanged pages from the previous epub")
+    command.add_argument("--delta", action="store_true", help="refetch only pages in the recent changes")
+    command.set_defaults(func=crawl)
+
+    command = commands.add_parser("rebuild", help="remake an epub from the cache only")
+    add_build_arguments(command)
+    command.set_defaults(func=rebuild)
+
+    command = commands.add_parser("rebuild-page-only", help="remake an epub from the cache only, without files")
+    add_build_arguments(command)
+    command.set_defaults(func=rebuild_page_only)
+
+    command = commands.add_parser("batch", help="make many epubs from a manifest (see batch.py)")
+    command.add_argument("manifest")
+    command.add_argument("summary", nargs="?")
+    command.set_defaults(func=run_batch)
+
+    return parser
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -7,15 +7,30 @@ from webutil import *
 from bs4 import BeautifulSoup
 import datetime
 import re
-from urllib.parse import urlparse, parse_qs, urljoin
-import base64
+from urllib.parse import urljoin
+import json
 import hashlib
 import time
-import vcr.matchers
-import extensions
-import magic
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, Future
+from build_cache import BuildCache
+from rewriter import LinkRewriter, set_attribute
+from asset_store import AssetStore
+from crawl_state import CrawlState
+from image_optimizer import ImageOptimizer, IMAGE_TYPES
+import mime_resolver
+from metrics import Metrics
 
 
+PAGE_RE = re.compile(r".+?/\?[^=\?]+$")
+CSS_RE = re.compile(r".+?\.css(\?.+)?$")
+IMAGE_RE = re.compile(r".+?\.(jpg|jpeg|gif|png)(\?.+)?$")
+CHANGED_AT_RE = re.compile(r"(\d{4}-\d{2}-\d{2})\D+?(\d{2}:\d{2}:\d{2})") # 最近の更新の一覧の日時（"2017-01-01 (日) 12:00:00"など）
+
+# ページの処理（書き換えやシリアライズ）の版。出力が変わるように処理を変えたら上げると、差分ビルドで前回のページを使わなくなる
+PROCESSING_VERSION = 1
+
 class WikiwikiScraper:
     
     def __init__(self, wiki_id, book_id=None):
@@ -25,8 +40,42 @@ class WikiwikiScraper:
         self.pages = {}
         self.book_title = None
         self.path_to_cassette = None
+        self.store = None
         self.wiki_id = wiki_id
         self.page_only = False
+        self.workers = 4 # ページや画像を並列にダウンロードするスレッドの数（0ならスレッドを使わず、その場でダウンロードする）
+        self.request_rate = 0.2 # 同じホストに1秒あたりに送るリクエストの数
+        self.request_burst = 1 # 同じホストに連続して送ってよいリクエストの数
+        self.style_dir = "wikiwiki" # assets/以下のスタイルシートのディレクトリ
+        self.render_processes = 0 # ページのレンダリングに使うプロセスの数（EpubMaker.render_processes）。テンプレートを通すparser="bs4"のページにだけ効く
+        self.compress_level = 6 # epubの圧縮のレベル（EpubMaker.compress_level、Noneなら無圧縮）
+        self.executor = None
+        self.lock = threading.Lock()
+        self.downloads = {}
+        self.pending = []
+        self.page_assets = {} # 処理中のページが使っているファイル（順番を保つためにdictを使う）
+        self.build_cache = None
+        self.strip_display_none = False # style属性からdisplay:noneを取り除くかどうか
+        self.rewriter = LinkRewriter(self)
+        self.parser = "bs4" # ページの処理に使うパーサ。"bs4"か"lxml"
+        self.asset_dir = None # ダウンロードしたファイルと処理したページを置くディレクトリ（Noneなら一時ディレクトリを使い、終わったら消す）
+        self.assets = None
+        self.blob_names = {} # ダウンロードしたファイルの中身のsha256 → epubに入れたファイル名
+        self.aliases = {} # 中身が他のファイルと同じだったファイル名 → epubに入れたファイル名
+        self.saved_bytes = 0 # 中身が同じファイルをまとめたことで、epubに入れずに済んだバイト数
+        self.changed = None # 差分クロールで取得し直すページのURL（Noneなら全てのページを取得する）
+        self.checkpoint_interval = 50 # 何ページごとにクロールの途中経過を<epub>.crawl/に書き出すか（0なら書き出さない）
+        self.crawl_state = None
+        self.finished = 0 # 処理の終わったページの数（self.pageurlsの先頭から）
+        self.shared_executor = None # 複数のビルドで共有するスレッドプール（Noneならビルドごとにworkers個のスレッドを使う）
+        self.image_profile = None # 画像を小さくするときの設定（image_optimizer.PROFILESのキーか辞書、Noneなら何もしない）
+        self.image_cache_dir = None # 小さくした画像を置いておく場所（Noneなら<epub>.cache/images）
+        self.image_processes = None # 画像の変換に使うプロセスの数（NoneならCPUの数）
+        self.optimizer = None
+        self.site = "wikiwiki" # 計測のラベルに使うサイトの種類
+        self.log_format = "text" # 進み具合の出力の形式（"text"か、1行に1つのJSONを出力する"json"）
+        self.metrics_path = None # ビルドの計測結果をPrometheusのtextfileとして書き出す場所（Noneなら書き出さない）
+        self.metrics = Metrics() # ビルドの計測（makeのたびに作り直す）
         
         self.hostname = "wikiwiki.jp"
         self.rooturl = "http://" + self.hostname + "/"
@@ -38,141 +87,549 @@ class WikiwikiScraper:
     
     # wikiに含まれる全てのページのURLを取得する
     def get_all_urls(self):
-        sitemap = BeautifulSoup(get_global_file(self.base_url + "?cmd=list"), "lxml")
+        sitemap = BeautifulSoup(self.fetch(self.base_url + "?cmd=list"), "lxml")
         site_urls = list(map(lambda x: x.get("href"), sitemap.select("#body > ul > li > ul > li > a")))
         return site_urls
     
-    # インターネット上のデータをダウンロードする
+    # 最近の更新の一覧から、(ページのURL, 更新日時 "YYYY-MM-DD HH:MM:SS")を新しい順に返す
+    def get_recent_changes(self):
+        page = BeautifulSoup(self.fetch(self.base_url + "?RecentChanges", refresh=True), "lxml")
+        for li in page.select("#body li"):
+            changed_at = CHANGED_AT_RE.search(li.text)
+            a = li.find("a")
+            if changed_at and a != None and a.get("href"):
+                yield (a.get("href"), changed_at.group(1) + " " + changed_at.group(2))
+    
+    # 差分クロールのページのURLを決める。
+    # 前回のビルドのページに、最近の更新の一覧のうち前回見た日時より新しいものを足す（一覧はそこで読むのをやめる）。
+    # 更新されたページはself.changedに入れる。
+    # 一覧の最後まで読んでも前回見た日時に届かなかった（一覧に載る数には上限がある）ときは、
+    # その間の更新を取りこぼしているかもしれないので、self.changedをNoneにしてサイトマップから全てのページを取得する。
+    def get_changed_urls(self):
+        since = self.build_cache.last_changed
+        known = dict((urljoin(self.base_url, url), url) for url in self.build_cache.previous)
+        site_urls = list(self.build_cache.previous)
+        self.changed = {}
+        for url, changed_at in self.get_recent_changes():
+            if changed_at <= since:
+                break
+            self.build_cache.last_changed = max(self.build_cache.last_changed, changed_at)
+            url = known.get(urljoin(self.base_url, url), url)
+            if not url in self.changed and not url in self.build_cache.previous:
+                site_urls.append(url)
+            self.changed[url] = True
+        else:
+            self.changed = None
+            return self.get_all_urls()
+        return site_urls
+    
+    # 最近の更新の一覧の、最新の日時（差分クロールの起点にする）
+    def get_last_changed(self):
+        for url, changed_at in self.get_recent_changes():
+            return changed_at
+        return None
+    
+    # インターネット上のデータのダウンロードを予約する。
+    # 同じpathのダウンロードは一度だけ行い、結果はFutureで返す。
+    # self.filesの順番を直列に処理した場合と揃えるため、予約した時点で場所を確保しておく。
     def download(self, url, path, mime_guess_method="content-type", custom_mime=None):
         if self.page_only == True:
-            return
+            return None
         
         url = urljoin(self.base_url, url)
-        if not path in self.files:
-            obj = get_global_file_as_object(url)
-            if obj.status_code == 404:
-                print("resource not found: " + url)
-                return
+        self.page_assets[path] = True
+        with self.lock:
+            if path in self.downloads:
+                return self.downloads[path]
+            self.files[path] = None
+            if self.executor != None:
+                future = self.executor.submit(self.download_now, url, path, mime_guess_method, custom_mime)
+                self.downloads[path] = future
+                return future
+            future = Future()
+            self.downloads[path] = future
+        
+        # プールが無ければその場でダウンロードする。download_nowもself.lockを取るので、ロックを放してから呼ぶ。
+        try:
+            future.set_result(self.download_now(url, path, mime_guess_method, custom_mime))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    
+    # インターネット上のデータをダウンロードし、ファイル名を返す（見つからなければNone）
+    def download_now(self, url, path, mime_guess_method="content-type", custom_mime=None):
+        try:
+            # 中身はメモリに載せず、少しずつディスクに書き出す
+            obj = self.fetch_object(url, stream=True)
+            try:
+                if obj.status_code == 404:
+                    self.metrics.count("not_found_total")
+                    self.metrics.event("not_found", "resource not found: " + url, url=url)
+                    with self.lock: # save_checkpointが別のスレッドでself.filesを読んでいることがある
+                        del self.files[path]
+                    return None
+                handle = self.assets.put_stream(obj.iter_content(65536))
+                self.metrics.count("files_downloaded_total")
+            finally:
+                obj.close()
             if mime_guess_method == "content-type":
-                mime = obj.headers.get("Content-Type", "").split(";")[0]
+                mime = mime_resolver.from_content_type(obj.headers.get("Content-Type"))
+                if mime == None:
+                    mime = mime_resolver.resolve(handle.head(mime_resolver.MAGIC_PREFIX), None, url)
+            elif mime_guess_method == "auto":
+                mime = mime_resolver.resolve(handle.head(mime_resolver.MAGIC_PREFIX), obj.headers.get("Content-Type"), url)
             elif mime_guess_method == "python-magic":
-                mime = magic.from_buffer(obj.content, mime=True)
+                import magic
+                mime = magic.from_buffer(handle.head(mime_resolver.MAGIC_PREFIX), mime=True)
             elif mime_guess_method == "custom" and type(custom_mime) == str:
                 mime = custom_mime
             else:
                 raise Exception('Invalid arguments')
-            self.files[path] = (obj.content, mime)
+            if self.optimizer != None:
+                handle, mime = self.optimizer.optimize(handle, mime, self.assets)
+            self.files[path] = (handle, mime)
+            return path
+        except Exception:
+            # 失敗したものは、次に参照されたときにもう一度ダウンロードする
+            with self.lock:
+                del self.files[path]
+                del self.downloads[path]
+            raise
     
-    # 各要素ごとに処理をする。
-    # 処理その１：scriptタグだったりしたら要素自体を消す、などの検閲作業
-    # 処理その２：cssやimgのURLをepub内のものに置き換える(sha256する)
-    # 処理その３：画像ファイルやcssなどをダウンロード＆self.filesに登録
-    #
-    # 作業メモ:
-    # 先ずは、hrefやsrcを全てsha256して内部のアドレスに置き換える。
-    # 次に、アドレスのうち画像やcssなどのアセットを指しているだろうと思われるものを全て取得し、filesに登録する。（その際パスはアドレスをsha256したもの+拡張子にする）
-    def process_element(self, element):
-        
-        if element.name == "script": # scriptタグは問答無用で削除
-            element.extract()
-            return
-        
-        if element.get("onclick"):
-            del element["onclick"] # onclickは問答無用で削除
-        
-        # href属性関連
-        href = element.get("href")
-        
-        if href:
-            o = urlparse(href)
-            qs = parse_qs(o[4])
-            
-            if not href.startswith("#"):
-                if re.match(r".+?/\?[^=\?]+$", href): # if page
-                    path = hashlib.sha256(href.encode()).hexdigest() + ".xhtml"
-                elif re.match(r".+?\.css(\?.+)?$", href): # if css
-                    try:
-                        path = "../files/" + hashlib.sha256(href.encode()).hexdigest() + ".css"
-                        self.download(href, hashlib.sha256(href.encode()).hexdigest() + ".css", "custom", "text/css")
-                    except Exception as e:
-                        path = ""
-                        print("network error occurred: " + str(e))
+    # キャッシュ（レスポンスストア）を通してインターネット上のデータを取得する
+    def fetch_object(self, url, stream=False, refresh=False):
+        return get_global_file_as_object(url, self.store, stream, refresh, self.metrics)
+    
+    def fetch(self, url, refresh=False):
+        return self.fetch_object(url, refresh=refresh).content
+    
+    # ページの本体を取得する。差分クロールで更新されていないページはNone（前回のビルドのものを使う）。
+    def fetch_page(self, url):
+        if self.changed == None:
+            return self.fetch(url)
+        if not url in self.changed:
+            return None
+        return self.fetch(url, refresh=True)
+    
+    # スレッドプールに処理を投げる。プールが無い場合はその場で実行する。
+    def submit(self, fn, *args):
+        if self.executor != None:
+            return self.executor.submit(fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    
+    # ダウンロードが終わったら、要素の属性を実際にepubに入れたファイルに向け直す（失敗したら空にする）
+    def defer(self, future, element, attr):
+        if future != None:
+            self.pending.append((future, element, attr))
+    
+    # 予約したダウンロードを全て待つ
+    def finish_downloads(self):
+        with self.metrics.timer("download_wait_seconds_total"):
+            for future, element, attr in self.pending:
+                try:
+                    filename = future.result()
+                    if filename != None:
+                        set_attribute(element, attr, "../files/" + self.dedup(filename))
+                except Exception as e:
+                    set_attribute(element, attr, "")
+                    self.metrics.count("download_errors_total")
+                    self.metrics.event("download_failed", "network error occurred: " + str(e), error=str(e))
+        self.pending = []
+    
+    # 扱えないURLを捨てる（classify_hrefとclassify_srcから）
+    def drop_url(self, url):
+        self.metrics.count("dropped_urls_total")
+        self.metrics.event("dropped_url", "dropped url: " + url, url=url)
+        return ("", None)
+    
+    # epubに入れるときのファイル名。拡張子が無ければMIMEから拡張子を付け、
+    # 画像の拡張子が他の画像のもの（image_profileでPNGをJPEGにしたときなど）なら、MIMEに合わせた拡張子に変える。
+    def file_name(self, path, mime):
+        extension = mime_resolver.extension_for(mime)
+        if extension == None:
+            return path
+        base, current = os.path.splitext(path)
+        if current == "":
+            return path + "." + extension
+        named = mime_resolver.from_extension(current[1:])
+        if mime in IMAGE_TYPES and named in IMAGE_TYPES and named != mime:
+            return base + "." + extension
+        return path
+    
+    # 中身が既にあるファイルと同じなら、そのファイルにまとめてそちらのファイル名を返す。
+    # ファイル名がMIMEと合わなければ（file_nameを参照）、合わせた名前に変える（まとめたのと同じように、元の名前からは向け直す）。
+    # どれにまとめるかがダウンロードの終わった順で変わらないように、ページと要素の順番に呼ぶ（finish_downloadsから）。
+    def dedup(self, path):
+        with self.lock:
+            if path in self.aliases:
+                return self.aliases[path]
+            handle, mime = self.files[path]
+            name = self.file_name(path, mime)
+            canonical = self.blob_names.setdefault(handle.digest, name)
+            if canonical != path:
+                file = self.files.pop(path)
+                if canonical == name:
+                    self.files[name] = file
                 else:
-                    path = ""
-                    print("dropped url: " + href)
-                
-                element["href"] = path
+                    self.saved_bytes += handle.size
+                self.aliases[path] = canonical
+            return canonical
+    
+    # トップページから本のタイトルを取得する
+    def get_book_title(self, top_page):
+        return top_page.title.text
+    
+    # 前回のビルドから本体が変わっていないページは、処理せずに前回のepubのものを使う
+    # fingerprintがNoneなら本体は比べない（差分クロールで更新されていないページ）
+    def reuse_page(self, pageurl, name, fingerprint):
+        entry = self.build_cache.lookup(pageurl, fingerprint)
+        if entry == None:
+            return False
+        if fingerprint == None:
+            fingerprint = entry["fingerprint"]
         
-        # src属性関連
-        src = element.get("src")
+        # 前回のepubのページはファイルをこの名前で参照しているので、必ずepubに入れる。
+        # 今回のビルドで先に処理したページが同じ名前のファイルを他のファイルにまとめていたり、404で外していたりしたら、前回のepubのものを入れ直す。
+        for filename, mime in entry["assets"].items():
+            with self.lock:
+                if filename in self.files:
+                    continue
+                if not filename in self.downloads:
+                    future = Future()
+                    future.set_result(None)
+                    self.downloads[filename] = future
+                self.files[filename] = (None, mime) # 中身はNone（前回のepubからコピーする）
         
-        if src:
-            o = urlparse(src)
-            qs = parse_qs(o[4])
-            
-            image_re = re.match(r".+?\.(jpg|jpeg|gif|png)(\?.+)?$", src)
-            if image_re: # if image
-                try:
-                    path = "../files/" + hashlib.sha256(src.encode()).hexdigest() + "." + image_re.group(1)
-                    self.download(src, hashlib.sha256(src.encode()).hexdigest() + "." + image_re.group(1), "python-magic")
-                except Exception as e:
-                    path = ""
-                    print("network error occurred: " + str(e))
-            else:
-                path = ""
-                print("dropped url: " + src)
-            
-            element["src"] = path
+        # まとめたファイル名は、他のページから参照されたときにまとめた先に向け直す
+        aliases = entry.get("aliases", {})
+        for path, canonical in aliases.items():
+            with self.lock:
+                if not path in self.downloads:
+                    future = Future()
+                    future.set_result(path)
+                    self.downloads[path] = future
+                    self.aliases[path] = canonical
+        
+        self.pages[name] = (entry["title"], None) # 中身はNone（前回のepubからコピーする）
+        self.build_cache.record(pageurl, fingerprint, name, entry["title"], entry["assets"], aliases)
+        return True
+    
+    # ページの本体を処理して、(タイトル, {"head": ..., "body": ...})を返す
+    def process_page(self, body):
+        if self.parser == "lxml":
+            return self.rewriter.process_lxml(body)
+        return self.rewriter.process_bs4(body)
+    
+    # 各要素ごとに処理をする。中身はLinkRewriter.process_elementを参照。
+    def process_element(self, element):
+        self.rewriter.process_element(element)
     
-    # 個別にepubを生成する。
-    def make(self, path_to_epub, path_to_cassette, record_mode="new_episodes", match_on=['uri']):        
+    # hrefの書き換え先と、ダウンロードするファイル（downloadの引数 または None）を決める。
+    # 作業メモ:
+    # hrefやsrcを全てsha256して内部のアドレスに置き換える。
+    # アドレスのうち画像やcssなどのアセットを指しているだろうと思われるものは、filesに登録する。（その際パスはアドレスをsha256したもの+拡張子にする）
+    def classify_href(self, href):
+        if PAGE_RE.match(href): # if page
+            return (self.rewriter.digest(href) + ".xhtml", None)
+        if CSS_RE.match(href): # if css
+            return ("../files/" + self.rewriter.digest(href) + ".css", (self.rewriter.digest(href) + ".css", "custom", "text/css"))
+        return self.drop_url(href)
+    
+    # srcの書き換え先と、ダウンロードするファイルを決める
+    def classify_src(self, src):
+        image_re = IMAGE_RE.match(src)
+        if image_re: # if image
+            filename = self.rewriter.digest(src) + "." + image_re.group(1)
+            return ("../files/" + filename, (filename, "auto"))
+        return self.drop_url(src)
+    
+    # incremental=Trueなら、epubの隣の<epub>.cache/を使って、前回から変わったページだけを処理する
+    # delta=Trueなら（incrementalも有効になる）、サイトマップの代わりに最近の更新の一覧を前回見たところまで読み、
+    # 更新されたページだけを取得し直す。それ以外のページは前回のepubのものを使う。
+    # resume=Trueなら、途中で止まったクロールを<epub>.crawl/に書き出しておいたところから再開する
+    def make(self, path_to_epub, path_to_cassette, record_mode="new_episodes", match_on=['uri'], incremental=False, delta=False, resume=False):        
         self.path_to_cassette = path_to_cassette
+        self.metrics = Metrics({"site": self.site, "wiki": self.wiki_id}, self.log_format)
+        start = time.perf_counter()
+        succeeded = False
+        
+        if incremental or delta:
+            options = {"page_only": self.page_only, "parser": self.parser, "processing_version": PROCESSING_VERSION, "strip_display_none": self.strip_display_none}
+            if self.image_profile != None:
+                options["image_profile"] = self.image_profile # 設定が変わったら前回の画像は使わない
+            self.build_cache = BuildCache(path_to_epub, options)
         
-        with vcr.use_cassette(self.path_to_cassette, record_mode=record_mode, match_on=match_on) as cassette:
-            # サーバに負荷をかけすぎないようにオンラインから取ってくるときは少し眠らせる黒魔術
-            def sleep(x):
-                for i in cassette.requests:
-                    if vcr.matchers.requests_match(x, i, cassette._match_on):
-                        return x
-                time.sleep(5)
-                return x
-            cassette._before_record_request = sleep
+        if self.checkpoint_interval > 0 or resume:
+            self.crawl_state = CrawlState(path_to_epub, resume)
+        
+        if self.asset_dir == None and self.crawl_state != None:
+            self.assets = self.crawl_state.asset_store() # 再開したときに使えるように、途中経過と一緒に置いておく
+        else:
+            self.assets = AssetStore(self.asset_dir)
+        try:
+            self.build(path_to_epub, record_mode, match_on, delta)
+            succeeded = True
+        except BaseException:
+            if self.crawl_state != None and self.finished > 0:
+                self.save_checkpoint()
+                self.metrics.event("checkpoint", "crawl state saved (%d pages done). run again with resume=True (--resume) to continue" % self.finished, finished=self.finished)
+            raise
+        finally:
+            self.assets.cleanup()
+            self.report_metrics(time.perf_counter() - start, succeeded)
+        
+        if self.crawl_state != None:
+            self.crawl_state.remove()
+    
+    # ビルドの計測結果を出力し、metrics_pathがあればPrometheusのtextfileに書き出す
+    def report_metrics(self, seconds, succeeded):
+        self.metrics.set("build_seconds", seconds)
+        self.metrics.set("build_success", 1 if succeeded else 0)
+        self.metrics.set("build_timestamp_seconds", time.time())
+        self.metrics.set("pages", len(self.pages))
+        self.metrics.set("files", len(self.files))
+        message = ("build finished in %.1f s" if succeeded else "build failed after %.1f s") % seconds
+        self.metrics.event("summary", message, seconds=seconds, succeeded=succeeded, metrics=self.metrics.snapshot())
+        if self.metrics_path != None:
+            self.metrics.write_textfile(self.metrics_path)
+    
+    # クロールの途中経過を書き出す（self.pageurlsのうち先頭からself.finished個のページは処理が終わっている）
+    def save_checkpoint(self):
+        pages = []
+        for pageurl in self.pageurls[:self.finished]:
+            title, data = self.pages[self.rewriter.digest(pageurl)]
+            pages.append([pageurl, title, data.digest if data != None else None])
+        
+        with self.lock:
+            files = [[path, file[0].digest if file[0] != None else None, file[1]] for path, file in self.files.items() if file != None]
+            aliases = dict(self.aliases)
+            blob_names = dict(self.blob_names)
+        
+        self.crawl_state.save({
+            "parser": self.parser,
+            "book_title": self.book_title,
+            "pageurls": self.pageurls,
+            "changed": list(self.changed) if self.changed != None else None,
+            "pages": pages,
+            "files": files,
+            "aliases": aliases,
+            "blob_names": blob_names,
+            "saved_bytes": self.saved_bytes,
+            "build_cache": {"current": self.build_cache.current, "last_changed": self.build_cache.last_changed} if self.build_cache != None else None,
+        })
+    
+    # 書き出しておいたクロールの途中経過を読み込み、処理の終わっていたページの(ページ名, タイトル, 中身)を返す。
+    # ディスクから消えていたファイルやページは、もう一度ダウンロード・処理する。
+    def load_checkpoint(self, state):
+        self.book_title = state["book_title"]
+        self.pageurls = state["pageurls"]
+        if state["changed"] != None:
+            self.changed = dict.fromkeys(state["changed"], True)
+        
+        for path, digest, mime in state["files"]:
+            handle = None
+            if digest != None:
+                handle = self.assets.get(digest)
+                if handle == None:
+                    continue
+            future = Future()
+            future.set_result(path if handle != None else None) # Noneは前回のepubからコピーするファイル
+            self.downloads[path] = future
+            self.files[path] = (handle, mime)
+        
+        for path, canonical in state["aliases"].items():
+            if canonical in self.files:
+                future = Future()
+                future.set_result(path)
+                self.downloads[path] = future
+                self.aliases[path] = canonical
+        
+        self.blob_names = dict((digest, path) for digest, path in state["blob_names"].items() if path in self.files)
+        self.saved_bytes = state["saved_bytes"]
+        
+        if self.build_cache != None and state["build_cache"] != None:
+            self.build_cache.current = state["build_cache"]["current"]
+            self.build_cache.last_changed = state["build_cache"]["last_changed"]
+        
+        resumed = []
+        if state.get("parser", "bs4") != self.parser: # 処理したページの形式が違うので、ページは処理し直す
+            state["pages"] = []
+        for pageurl, title, digest in state["pages"]:
+            data = None
+            if digest != None:
+                data = self.assets.get(digest)
+                if data == None:
+                    break
+            elif self.build_cache == None:
+                break
+            name = self.rewriter.digest(pageurl)
+            self.pages[name] = (title, data)
+            resumed.append((name, title, data))
+        self.finished = len(resumed)
+        return resumed
+    
+    # ページを順番に取得・処理して、(ページ名, タイトル, ディスクに書き出した中身)を返していく。
+    # 前回のepubのものをそのまま使うページは中身がNoneになる。
+    # resumedは再開したときに処理の終わっていたページで、これらはそのまま返す。
+    def generate_pages(self, resumed=[]):
+        for page in resumed:
+            yield page
+        
+        start = len(resumed)
+        
+        # ページの本体は先読みしておき、処理自体はページの順番通りに行う
+        bodies = map_bounded(self, self.fetch_page, self.pageurls[start:], max(1, self.workers * 2)) # self.submitはプールが無ければその場で実行する
+        
+        for i, pageurl in enumerate(self.pageurls[start:], start):
+            with self.metrics.timer("page_wait_seconds_total"): # 先読みが間に合わずに待った時間
+                body = next(bodies)
             
-            print("getting site info...")
-            top_page = BeautifulSoup(get_global_file(self.base_url), "lxml") # トップページを取得
-            self.book_title = top_page.title.text # タイトルを取得
+            self.finished = i
+            if self.crawl_state != None and self.checkpoint_interval > 0 and i > start and i % self.checkpoint_interval == 0:
+                self.save_checkpoint()
             
-            print("getting site map...")
-            self.pageurls = self.get_all_urls() # サイトの全ページのURLを取得
+            self.metrics.event("page", "Page: " + pageurl + " " + str(i) + "/" + str(len(self.pageurls)), url=pageurl, index=i, total=len(self.pageurls))
             
-            print("generating pages...")
+            name = self.rewriter.digest(pageurl)
+            fingerprint = hashlib.sha256(body).hexdigest() if body != None else None
             
-            for i, pageurl in enumerate(self.pageurls):
-                print("Page: " + pageurl + " " + str(i) + "/" + str(len(self.pageurls)))
-                
-                page = BeautifulSoup(get_global_file(pageurl), "lxml")
-                
-                list(map(self.process_element, page.select("*")))
-                
-                page.head.append(page.new_tag('link', rel="stylesheet", href="../files/style.css", type="text/css"))
-                
-                self.pages[hashlib.sha256(pageurl.encode()).hexdigest()] = (page.title.text, {"head": str(page.head), "body": str(page.body)})
+            if self.build_cache != None and self.reuse_page(pageurl, name, fingerprint):
+                self.metrics.count("pages_total", state="reused")
+                yield (name, self.pages[name][0], None)
+                continue
+            
+            if body == None: # 前回のepubに無かったら取得し直す
+                body = self.fetch(pageurl, refresh=True)
+                fingerprint = hashlib.sha256(body).hexdigest()
+            
+            self.page_assets = {}
+            
+            with self.metrics.timer("page_process_seconds_total"): # 要素のダウンロードを待った時間も含む
+                title, data = self.process_page(body)
+            data = self.assets.put(json.dumps(data).encode("utf-8"))
+            self.metrics.count("pages_total", state="processed")
             
-            print("constructing an EpubMaker object...")
+            self.pages[name] = (title, data)
+            
+            if self.build_cache != None:
+                assets = {}
+                aliases = {}
+                for path in self.page_assets:
+                    if path in self.aliases:
+                        aliases[path] = self.aliases[path]
+                        path = self.aliases[path]
+                    if path in self.files:
+                        assets[path] = self.files[path][1]
+                self.build_cache.record(pageurl, fingerprint, name, title, assets, aliases)
+            
+            yield (name, title, data)
+        
+        self.finished = len(self.pageurls)
+    
+    # makeの本体
+    def build(self, path_to_epub, record_mode, match_on, delta=False):
+        # サーバに負荷をかけすぎないようにオンラインから取ってくるときはレート制限をかける
+        # path_to_cassetteが既存のvcrのカセットならそれを、そうでなければレスポンスストアを使う
+        if self.shared_executor != None:
+            pool = contextlib.nullcontext(self.shared_executor)
+        else:
+            pool = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 0 else contextlib.nullcontext(None)
+        with use_cache(self.path_to_cassette, record_mode, match_on, self.request_rate, self.request_burst) as store, pool as executor:
+            self.store = store
+            self.executor = executor
+            
+            resumed = []
+            if self.crawl_state != None and self.crawl_state.state != None:
+                resumed = self.load_checkpoint(self.crawl_state.state)
+                self.metrics.event("phase", "resuming from page %d/%d..." % (len(resumed), len(self.pageurls)), phase="resume", finished=len(resumed), total=len(self.pageurls))
+            else:
+                with self.metrics.timer("phase_seconds_total", phase="sitemap"):
+                    self.metrics.event("phase", "getting site info...", phase="site_info")
+                    top_page = BeautifulSoup(self.fetch(self.base_url), "lxml") # トップページを取得
+                    self.book_title = self.get_book_title(top_page) # タイトルを取得
+                    
+                    self.metrics.event("phase", "getting site map...", phase="sitemap")
+                    if delta and self.build_cache.previous and self.build_cache.last_changed != None:
+                        since = self.build_cache.last_changed
+                        self.pageurls = self.get_changed_urls() # 前回から更新されたページのURLだけを取得
+                        if self.changed != None:
+                            self.metrics.event("phase", "%d pages changed since %s" % (len(self.changed), since), phase="delta", changed=len(self.changed), since=since)
+                        else:
+                            self.metrics.event("phase", "recent changes do not reach back to %s, getting all pages" % since, phase="delta", since=since)
+                    else:
+                        if delta:
+                            self.build_cache.last_changed = self.get_last_changed()
+                        self.pageurls = self.get_all_urls() # サイトの全ページのURLを取得
+            
+            self.metrics.event("phase", "constructing an EpubMaker object...", phase="maker")
             maker = EpubMaker("ja-JP", self.book_title, "知らん", "知らん", "知らん", identifier=self.book_id)
+            maker.render_processes = self.render_processes
+            maker.compress_level = self.compress_level
+            maker.metrics = self.metrics
+            
+            if self.image_profile != None and not self.page_only:
+                cache_dir = self.image_cache_dir if self.image_cache_dir != None else os.path.join(path_to_epub + ".cache", "images")
+                self.optimizer = ImageOptimizer(self.image_profile, cache_dir, self.image_processes, self.metrics)
+            
+            self.metrics.event("phase", "generating pages...", phase="pages", total=len(self.pageurls))
             
-            print("adding files and pages to the EpubMaker object...")
-            for name, page in self.pages.items():
-                maker.addPage(name, page[0], page[1])
+            # 処理したページはすぐにディスクに書き出し、メモリにはタイトルと順番だけを残す
+            # XHTMLとしてシリアライズしてあるのはlxmlで処理したページだけ。BeautifulSoupの出力はHTMLなので、テンプレートを通す。
+            try:
+                with self.metrics.timer("phase_seconds_total", phase="pages"):
+                    for name, title, data in self.generate_pages(resumed):
+                        if data == None:
+                            maker.reusePage(name, title, self.build_cache.previous_epub)
+                        elif self.parser == "lxml":
+                            maker.addXhtmlPage(name, title, data)
+                        else:
+                            maker.addPage(name, title, data)
+            finally:
+                if self.optimizer != None:
+                    self.optimizer.close()
+            
+            if self.optimizer != None:
+                optimizer = self.optimizer
+                self.metrics.set("images_optimized", optimizer.converted)
+                self.metrics.set("images_optimized_cached", optimizer.cached)
+                self.metrics.set("image_saved_bytes", optimizer.saved_bytes)
+                self.metrics.event("images", "optimized %d images, %d from the previous results (%d bytes saved)" % (optimizer.converted, optimizer.cached, optimizer.saved_bytes),
+                                   converted=optimizer.converted, cached=optimizer.cached, saved_bytes=optimizer.saved_bytes)
+                self.optimizer = None
+            
+            self.executor = None
+            self.store = None
+            
+            self.metrics.event("phase", "adding files to the EpubMaker object...", phase="files", files=len(self.files))
+            with self.metrics.timer("phase_seconds_total", phase="files"):
+                for filename, file in self.files.items():
+                    if file[0] == None:
+                        maker.reuseFile(filename, file[1], self.build_cache.previous_epub)
+                    else:
+                        maker.addFile(filename, file[0], file[1])
+                
+                maker.addFile("style.css", get_local_file(script_path("assets", self.style_dir, "style.css")), "text/css")
             
-            for filename, file in self.files.items():
-                maker.addFile(filename, file[0], file[1])
+            deduplicated = [path for path, canonical in self.aliases.items() if not canonical in self.files or canonical != self.file_name(path, self.files[canonical][1])] # 名前を変えただけのものは除く
+            self.metrics.set("deduplicated_files", len(deduplicated))
+            self.metrics.set("deduplicated_saved_bytes", self.saved_bytes)
+            if deduplicated:
+                self.metrics.event("dedup", "deduplicated %d files (%d bytes saved)" % (len(deduplicated), self.saved_bytes), files=len(deduplicated), saved_bytes=self.saved_bytes)
             
-            maker.addFile("style.css", get_local_file(script_path("assets", "wikiwiki", "style.css")), "text/css")
+            self.metrics.event("phase", "making epub file...", phase="epub")
+            with self.metrics.timer("phase_seconds_total", phase="epub"):
+                maker.doMake(path_to_epub)
             
-            print("making epub file...")
-            maker.doMake(path_to_epub)
+            if self.build_cache != None:
+                self.build_cache.save()
 
 if __name__ == '__main__':
-    scraper = WikiwikiScraper(sys.argv[1])
-    scraper.make(sys.argv[2], sys.argv[3])
\ No newline at end of file
+    # --resumeを付けると、途中で止まったクロールを続きから再開する
+    args = [arg for arg in sys.argv[1:] if arg != "--resume"]
+    scraper = WikiwikiScraper(args[0])
+    scraper.make(args[1], args[2], resume="--resume" in sys.argv)
\ No newline at end of file
@@ -1,9 +1,9 @@
 # wikiwiki.jp scraper
 
 import sys
-from webutil import *
 from wikiwiki_scraper import WikiwikiScraper
 
 if __name__ == '__main__':
-    scraper = WikiwikiScraper(sys.argv[1])
-    scraper.make(sys.argv[2], sys.argv[3], record_mode="none")
\ No newline at end of file
+    args = [arg for arg in sys.argv[1:] if arg != "--resume"]
+    scraper = WikiwikiScraper(args[0])
+    scraper.make(args[1], args[2], record_mode="none", incremental=True, resume="--resume" in sys.argv)
\ No newline at end of file